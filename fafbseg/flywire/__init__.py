@@ -21,5 +21,6 @@ from .skeletonize import *
 from .merge import *
 from .meshes import *
 from .synapses import *
+from .materialize import *
 from .utils import *
 from .l2 import *
@@ -0,0 +1,288 @@
+#    A collection of tools to interface with manually traced and autosegmented
+#    data in FAFB.
+#
+#    Copyright (C) 2019 Philipp Schlegel
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+
+"""Materialized supervoxel -> root mapping for the synapse table."""
+
+import datetime as dt
+import navis
+
+import numpy as np
+
+from pathlib import Path
+
+from .segmentation import supervoxels_to_roots, is_latest_root
+from .utils import FLYWIRE_DATASETS
+
+__all__ = ['materialize_roots', 'clear_materialization']
+
+# The currently active materialization (None if not used)
+MATERIALIZATION = None
+
+
+class MaterializedRoots:
+    """Supervoxel -> root ID mapping for all synapses in a synapse table.
+
+    Root IDs of pre- and postsynaptic partners are looked up via
+    ``np.searchsorted`` on the sorted supervoxel IDs instead of asking the
+    chunkedgraph. :meth:`MaterializedRoots.refresh` only re-resolves the
+    supervoxels whose root has changed since the last update.
+
+    Parameters
+    ----------
+    supervoxels :   np.ndarray
+                    Sorted, unique supervoxel IDs.
+    roots :         np.ndarray
+                    Root ID for each supervoxel.
+    dataset :       str
+                    Flywire dataset the roots refer to.
+    timestamp :     str, optional
+                    When the mapping was last updated.
+    filepath :      str, optional
+                    Where the mapping is persisted (``.npz``).
+
+    """
+
+    def __init__(self, supervoxels, roots, dataset='production',
+                 timestamp=None, filepath=None):
+        """Initialize."""
+        self.supervoxels = np.asarray(supervoxels, dtype=np.int64)
+        self.roots = np.asarray(roots, dtype=np.int64)
+        self.dataset = dataset
+        self.timestamp = timestamp or dt.datetime.now().isoformat()
+        self.filepath = Path(filepath).expanduser() if filepath else None
+
+    def __len__(self):
+        return len(self.supervoxels)
+
+    def __repr__(self):
+        return (f'<MaterializedRoots dataset="{self.dataset}" '
+                f'supervoxels={len(self)} updated={self.timestamp}>')
+
+    @classmethod
+    def from_synapses(cls, synapses, dataset='production', chunksize=1e6,
+                      filepath=None, progress=True):
+        """Materialize root IDs for all supervoxels in a synapse table.
+
+        Parameters
+        ----------
+        synapses :      SynapseTable
+                        See :class:`fafbseg.synapses.SynapseTable`.
+        dataset :       str
+                        Flywire dataset to map to.
+        chunksize :     int
+                        Number of supervoxels to map per query.
+        filepath :      str, optional
+                        File to persist to.
+        progress :      bool
+                        Whether to show a progress bar.
+
+        """
+        svoxels = np.unique(np.concatenate((synapses.get_index('pre')[0],
+                                            synapses.get_index('post')[0])))
+        roots = _supervoxels_to_roots(svoxels, dataset=dataset,
+                                      chunksize=chunksize,
+                                      progress=progress)
+
+        return cls(svoxels, roots, dataset=dataset, filepath=filepath)
+
+    @classmethod
+    def load(cls, filepath):
+        """Load materialization from disk."""
+        filepath = Path(filepath).expanduser()
+        with np.load(filepath) as data:
+            return cls(data['supervoxels'], data['roots'],
+                       dataset=str(data['dataset']),
+                       timestamp=str(data['timestamp']),
+                       filepath=filepath)
+
+    def save(self, filepath=None):
+        """Save materialization to disk."""
+        filepath = Path(filepath).expanduser() if filepath else self.filepath
+        if not filepath:
+            raise ValueError('Must provide filepath')
+
+        filepath.parent.mkdir(parents=True, exist_ok=True)
+        with open(filepath, 'wb') as f:
+            np.savez(f,
+                     supervoxels=self.supervoxels,
+                     roots=self.roots,
+                     dataset=self.dataset,
+                     timestamp=self.timestamp)
+
+    def refresh(self, chunksize=1e5, progress=True):
+        """Update roots that have been edited since the last update.
+
+        Checks the distinct root IDs via
+        :func:`~fafbseg.flywire.is_latest_root` and re-resolves only the
+        supervoxels belonging to outdated roots.
+
+        Returns
+        -------
+        int
+                        Number of supervoxels that were updated.
+
+        """
+        distinct = np.unique(self.roots[self.roots != 0])
+
+        chunksize = int(chunksize)
+        is_latest = np.ones(len(distinct), dtype=bool)
+        with navis.config.tqdm(desc='Checking roots',
+                               total=len(distinct),
+                               disable=not progress or len(distinct) <= chunksize,
+                               leave=False) as pbar:
+            for i in range(0, len(distinct), chunksize):
+                chunk = distinct[i: i + chunksize]
+                is_latest[i: i + chunksize] = is_latest_root(chunk,
+                                                             dataset=self.dataset)
+                pbar.update(len(chunk))
+
+        outdated = distinct[~is_latest]
+        to_update = np.isin(self.roots, outdated)
+        if np.any(to_update):
+            self.roots[to_update] = _supervoxels_to_roots(self.supervoxels[to_update],
+                                                          dataset=self.dataset,
+                                                          progress=progress)
+
+        self.timestamp = dt.datetime.now().isoformat()
+
+        return int(to_update.sum())
+
+    def lookup(self, svoxels):
+        """Look up roots for given supervoxels.
+
+        Returns
+        -------
+        roots :     np.ndarray
+                    Root IDs. 0 for supervoxels that aren't materialized.
+        found :     np.ndarray
+                    Boolean array indicating which supervoxels were found.
+
+        """
+        svoxels = np.asarray(svoxels, dtype=np.int64)
+        if not len(self.supervoxels):
+            return np.zeros(svoxels.shape, dtype=np.int64), np.zeros(svoxels.shape, dtype=bool)
+
+        ix = np.searchsorted(self.supervoxels, svoxels)
+        ix[ix >= len(self.supervoxels)] = 0
+        found = self.supervoxels[ix] == svoxels
+
+        return np.where(found, self.roots[ix], 0), found
+
+
+def materialize_roots(filepath, synapses=None, dataset='production',
+                      refresh=True, progress=True):
+    """Materialize (and use) root IDs for all synapses in a synapse table.
+
+    On first call, this maps all pre- and postsynaptic supervoxels in the
+    synapse table to root IDs and saves the mapping to ``filepath``.
+    Subsequent calls load the mapping and refresh it incrementally: only
+    supervoxels of roots that are no longer current are re-resolved.
+
+    Once materialized, :func:`~fafbseg.flywire.fetch_synapses` and
+    :func:`~fafbseg.flywire.fetch_connectivity` look up partner roots
+    locally instead of asking the chunkedgraph.
+
+    Parameters
+    ----------
+    filepath :      str
+                    File (``.npz``) to persist the materialization to.
+    synapses :      SynapseTable | str, optional
+                    Synapse table to materialize. Only required on first
+                    call. If not provided, will use the table set via
+                    :func:`~fafbseg.flywire.use_local_synapses`.
+    dataset :       str
+                    Against which flywire dataset to materialize::
+                        - "production" (current production dataset, fly_v31)
+                        - "sandbox" (i.e. fly_v26)
+    refresh :       bool
+                    Whether to refresh an existing materialization.
+    progress :      bool
+                    Whether to show progress bars.
+
+    Returns
+    -------
+    MaterializedRoots
+
+    Examples
+    --------
+    >>> from fafbseg import flywire
+    >>> flywire.use_local_synapses('~/flywire_synapses.feather')
+    >>> flywire.materialize_roots('~/flywire_synapse_roots.npz')
+
+    """
+    global MATERIALIZATION
+
+    filepath = Path(filepath).expanduser()
+
+    if filepath.is_file():
+        mat = MaterializedRoots.load(filepath)
+        if mat.dataset != dataset:
+            raise ValueError(f'Materialization in "{filepath}" is for dataset '
+                             f'"{mat.dataset}", not "{dataset}"')
+        if refresh and mat.refresh(progress=progress):
+            mat.save()
+    else:
+        if synapses is None:
+            from . import synapses as syn
+            synapses = syn.SYNAPSE_BACKEND
+
+        if synapses is None:
+            raise ValueError('Must provide a synapse table - either via '
+                             '`synapses` or `flywire.use_local_synapses()`.')
+
+        if not hasattr(synapses, 'get_index'):
+            from ..synapses.local import SynapseTable
+            synapses = SynapseTable(synapses)
+
+        mat = MaterializedRoots.from_synapses(synapses, dataset=dataset,
+                                              filepath=filepath,
+                                              progress=progress)
+        mat.save()
+
+    MATERIALIZATION = mat
+
+    return mat
+
+
+def clear_materialization():
+    """Stop using materialized root IDs."""
+    global MATERIALIZATION
+    MATERIALIZATION = None
+
+
+def get_materialization(dataset='production'):
+    """Return active materialization for given dataset (or None)."""
+    if MATERIALIZATION is None or not isinstance(dataset, str):
+        return None
+
+    if FLYWIRE_DATASETS.get(MATERIALIZATION.dataset, MATERIALIZATION.dataset) \
+       != FLYWIRE_DATASETS.get(dataset, dataset):
+        return None
+
+    return MATERIALIZATION
+
+
+def _supervoxels_to_roots(svoxels, dataset='production', chunksize=1e6,
+                          progress=True):
+    """Map supervoxels to roots in chunks."""
+    roots = np.zeros(len(svoxels), dtype=np.int64)
+    chunksize = int(chunksize)
+    for i in navis.config.tqdm(range(0, len(svoxels), chunksize),
+                               desc='Mapping supervoxels',
+                               disable=not progress or len(svoxels) <= chunksize,
+                               leave=False):
+        roots[i: i + chunksize] = supervoxels_to_roots(svoxels[i: i + chunksize],
+                                                       dataset=dataset)
+    return roots
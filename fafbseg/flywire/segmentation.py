@@ -30,6 +30,8 @@ from scipy import ndimage
 
 from .. import spine
 from .. import xform
+from ..utils import overlap_counts, overlap_matrix
+from ..volumes import LocalVolume
 
 from .utils import parse_volume, FLYWIRE_DATASETS, get_chunkedgraph_secret
 
@@ -43,7 +45,55 @@ except BaseException:
 __all__ = ['fetch_edit_history', 'fetch_leaderboard', 'locs_to_segments',
            'locs_to_supervoxels', 'skid_to_id', 'update_ids',
            'roots_to_supervoxels', 'supervoxels_to_roots',
-           'neuron_to_segments', 'is_latest_root']
+           'neuron_to_segments', 'is_latest_root',
+           'use_local_segmentation', 'use_spine_segmentation']
+
+# Local copy of the supervoxel segmentation (None if using spine)
+LOCAL_SEGMENTATION = None
+
+
+def use_local_segmentation(path, mip=0, cache_size=256, max_threads=4,
+                           **kwargs):
+    """Use a local copy of the supervoxel segmentation.
+
+    Once set, :func:`~fafbseg.flywire.locs_to_supervoxels` (and by extension
+    :func:`~fafbseg.flywire.locs_to_segments`) will look up supervoxels
+    locally. Mapping supervoxels to root IDs still requires the chunkedgraph.
+
+    Parameters
+    ----------
+    path :          str | CloudVolume
+                    Path to the local copy (directory with the ``info`` file)
+                    of the flywire watershed segmentation.
+    mip :           int
+                    Scale to query. Use the highest resolution (typically
+                    mip 0) to get the same results as the spine service.
+    cache_size :    int
+                    Max number of decoded chunks to keep in memory.
+    max_threads :   int
+                    Number of threads used to decode chunks.
+    **kwargs
+                    Keyword arguments passed on to ``cloudvolume.CloudVolume``.
+
+    Returns
+    -------
+    None
+
+    See Also
+    --------
+    :func:`~fafbseg.flywire.use_spine_segmentation`
+                    Switch back to the spine web service.
+
+    """
+    global LOCAL_SEGMENTATION
+    LOCAL_SEGMENTATION = LocalVolume(path, mip=mip, cache_size=cache_size,
+                                     max_threads=max_threads, **kwargs)
+
+
+def use_spine_segmentation():
+    """Use the spine web service to look up supervoxels (default)."""
+    global LOCAL_SEGMENTATION
+    LOCAL_SEGMENTATION = None
 
 
 def fetch_leaderboard(days=7, by_day=False, progress=True, max_threads=4):
@@ -361,10 +411,11 @@ def supervoxels_to_roots(x, use_cache=False, dataset='production'):
     return roots
 
 
-def locs_to_supervoxels(locs, mip=2, coordinates='voxel'):
+def locs_to_supervoxels(locs, mip=None, coordinates='voxel'):
     """Retrieve flywire supervoxel IDs at given location(s).
 
-    Use Eric Perlman's service on spine.
+    Use Eric Perlman's service on spine unless a local copy of the
+    segmentation has been set via :func:`~fafbseg.flywire.use_local_segmentation`.
 
     Parameters
     ----------
@@ -372,10 +423,11 @@ def locs_to_supervoxels(locs, mip=2, coordinates='voxel'):
                     Array of x/y/z coordinates. If DataFrame must contain
                     'x', 'y', 'z' or 'fw.x', 'fw.y', 'fw.z' columns. If both
                     present, 'fw.' columns take precedence!
-    mip :           int [2-8]
-                    Scale to query. Lower mip = more precise but slower;
-                    higher mip = faster but less precise (small supervoxels
-                    might not show at all).
+    mip :           int, optional
+                    Scale to query. The spine service always uses the highest
+                    available resolution. If a local copy is used (see
+                    :func:`~fafbseg.flywire.use_local_segmentation`) and
+                    ``mip`` is given, it must match the local copy's mip.
     coordinates :   "voxel" | "nm"
                     Units in which your coordinates are in. "voxel" is assumed
                     to be 4x4x40 (x/y/z) nanometers.
@@ -408,11 +460,18 @@ def locs_to_supervoxels(locs, mip=2, coordinates='voxel'):
         if not np.issubdtype(locs.dtype, np.number):
             locs = locs.astype(np.float64)
 
+    if LOCAL_SEGMENTATION is not None:
+        if mip is not None and mip != LOCAL_SEGMENTATION.mip:
+            raise ValueError(f'Local segmentation is at mip {LOCAL_SEGMENTATION.mip}'
+                             f', not {mip}.')
+        return LOCAL_SEGMENTATION.lookup(locs, coordinates=coordinates)
+
     return spine.transform.get_segids(locs, segmentation='flywire_190410',
                                       coordinates=coordinates, mip=-1)
 
 
-def neuron_to_segments(x, dataset='production', coordinates='voxel'):
+def neuron_to_segments(x, dataset='production', coordinates='voxel',
+                       sparse=False):
     """Get root IDs overlapping with a given neuron.
 
     Parameters
@@ -428,18 +487,29 @@ def neuron_to_segments(x, dataset='production', coordinates='voxel'):
     coordinates :       "voxel" | "nm"
                         Units the neuron(s) are in. "voxel" is assumed to be
                         4x4x40 (x/y/z) nanometers.
+    sparse :            bool
+                        If True, will return a sparse table of (ID, root ID,
+                        counts) instead of a dense matrix. Use this for large
+                        lists of neurons.
 
     Returns
     -------
     overlap_matrix :    pandas.DataFrame
-                        DataFrame of root IDs (rows) and IDs
-                        (columns) with overlap in nodes as values::
+                        If ``sparse=False``: DataFrame of root IDs (rows) and
+                        IDs (columns) with overlap in nodes as values::
 
                                  id     id1   id2
                             root_id
                             10336680915   5     0
                             10336682132   0     1
 
+                        If ``sparse=True``: DataFrame with one row per
+                        overlapping neuron and root ID::
+
+                                id      root_id  counts
+                            0  id1  10336680915       5
+                            1  id2  10336682132       1
+
     """
     if isinstance(x, navis.TreeNeuron):
         x = navis.NeuronList(x)
@@ -454,18 +524,16 @@ def neuron_to_segments(x, dataset='production', coordinates='voxel'):
                                         coordinates=coordinates,
                                         root_ids=True, dataset=dataset)
 
-    # Count segment IDs
-    seg_counts = nodes.groupby(['neuron', 'root_id'], as_index=False).node_id.count()
-    seg_counts.columns = ['id', 'root_id', 'counts']
+    # Count segment IDs (ignores seg IDs 0)
+    seg_counts = overlap_counts(nodes.neuron.values, nodes.root_id.values,
+                                id_col='id', seg_col='root_id')
 
-    # Remove seg IDs 0
-    seg_counts = seg_counts[seg_counts.root_id != 0]
+    if sparse:
+        return seg_counts
 
     # Turn into matrix where columns are skeleton IDs, segment IDs are rows
     # and values are the overlap counts
-    matrix = seg_counts.pivot(index='root_id', columns='id', values='counts')
-
-    return matrix
+    return overlap_matrix(seg_counts, id_col='id', seg_col='root_id')
 
 
 def locs_to_segments(locs, root_ids=True, dataset='production',
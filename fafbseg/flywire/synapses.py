@@ -13,23 +13,93 @@
 #    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
 #    GNU General Public License for more details.
 
+import hashlib
 import navis
+import os
 
 import numpy as np
 import pandas as pd
+import pyarrow as pa
+import scipy.sparse as sp
+
+from pathlib import Path
 
 from .segmentation import roots_to_supervoxels, supervoxels_to_roots, is_latest_root
 from .utils import parse_root_ids
+from .materialize import get_materialization
 
-from ..synapses.utils import catmaid_table
-from ..synapses.transmitters import collapse_nt_predictions
+from ..synapses.utils import catmaid_table, closest_nodes
+from ..synapses.transmitters import collapse_nt_predictions, nt_confidence, trans
+from ..synapses.local import SynapseTable
 from .. import spine
 
 __all__ = ['fetch_synapses', 'fetch_connectivity', 'predict_transmitter',
-           'fetch_adjacency']
+           'fetch_adjacency', 'use_local_synapses', 'use_spine_synapses']
+
+# Where to get synapses from - None means the spine web service
+SYNAPSE_BACKEND = None
+
+
+def use_local_synapses(filepath=None):
+    """Use a local dump of the synapse table instead of the spine service.
+
+    Once set, :func:`~fafbseg.flywire.fetch_synapses`,
+    :func:`~fafbseg.flywire.fetch_connectivity`,
+    :func:`~fafbseg.flywire.fetch_adjacency` and
+    :func:`~fafbseg.flywire.predict_transmitter` will read synapses from local
+    disk. Note that mapping supervoxels to root IDs still requires the
+    chunkedgraph.
+
+    Parameters
+    ----------
+    filepath :      str | SynapseTable, optional
+                    Parquet or Feather file with the synapse table (pre/post
+                    supervoxel IDs, cleft scores and optionally locations and
+                    neurotransmitter predictions). If not provided will
+                    try to use ``FLYWIRE_SYNAPSE_DUMP`` environment variable.
+
+    Returns
+    -------
+    None
+
+    See Also
+    --------
+    :func:`~fafbseg.flywire.use_spine_synapses`
+                    Switch back to the spine web service.
+
+    """
+    global SYNAPSE_BACKEND
+
+    if not filepath:
+        filepath = os.environ.get('FLYWIRE_SYNAPSE_DUMP', None)
+
+    if not filepath:
+        raise ValueError('Must provided filepath to synapse table either as '
+                         '`filepath` parameter or as `FLYWIRE_SYNAPSE_DUMP` '
+                         'environment variable.')
+
+    if not isinstance(filepath, SynapseTable):
+        filepath = SynapseTable(filepath)
+
+    SYNAPSE_BACKEND = filepath
+
+
+def use_spine_synapses():
+    """Use the spine web service to fetch synapses (default)."""
+    global SYNAPSE_BACKEND
+    SYNAPSE_BACKEND = None
+
+
+def get_synapse_backend():
+    """Return the currently active synapse backend."""
+    if SYNAPSE_BACKEND is None:
+        return spine.synapses
+    return SYNAPSE_BACKEND
 
 
-def predict_transmitter(x, single_pred=False, dataset='production'):
+def predict_transmitter(x, single_pred=False, dataset='production',
+                        stream=False, chunksize=50000, accumulator=None,
+                        progress=True):
     """Fetch neurotransmitter predictions for neurons.
 
     Based on Eckstein et al. (2020). Uses a service on spine.janelia.org hosted
@@ -54,6 +124,20 @@ def predict_transmitter(x, single_pred=False, dataset='production'):
                     Against which flywire dataset to query::
                         - "production" (current production dataset, fly_v31)
                         - "sandbox" (i.e. fly_v26)
+    stream :        bool
+                    If True, will query synapses in chunks of supervoxels and
+                    only keep running per-neuron sums instead of the full
+                    synapse table. Use this for very large sets of neurons.
+                    Neurons without any predictions get a confidence of 0
+                    instead of raising an error.
+    chunksize :     int
+                    Number of supervoxels per chunk if ``stream=True``.
+    accumulator :   str, optional
+                    File (``.npz``) to save the running sums to after each
+                    chunk if ``stream=True``. If the file exists, will resume
+                    from there.
+    progress :      bool
+                    Whether to show progress bars.
 
     Returns
     -------
@@ -66,16 +150,116 @@ def predict_transmitter(x, single_pred=False, dataset='production'):
                     `(top_transmitter, confidence)` tuple for each query neuron.
 
     """
+    if stream:
+        return _predict_transmitter_streaming(x,
+                                              single_pred=single_pred,
+                                              dataset=dataset,
+                                              chunksize=chunksize,
+                                              accumulator=accumulator,
+                                              progress=progress)
+
     # First get the synapses
     syn = fetch_synapses(x, pre=True, post=False, attach=False, min_score=None,
-                         transmitters=True)
+                         transmitters=True, dataset=dataset, progress=progress)
 
     # Get the predictions
     return collapse_nt_predictions(syn, single_pred=single_pred, id_col='pre')
 
 
+def _predict_transmitter_streaming(x, single_pred=False, dataset='production',
+                                   chunksize=50000, accumulator=None,
+                                   progress=True):
+    """Predict transmitters chunk by chunk. See ``predict_transmitter``."""
+    ids = np.unique(parse_root_ids(x).astype(np.int64))
+
+    roots2svxl = roots_to_supervoxels(ids, dataset=dataset, progress=progress)
+    keys, values = _svxl_lookup(roots2svxl)
+
+    # Split supervoxels into chunks - since each supervoxel belongs to a
+    # single root, every presynapse is counted in exactly one chunk. Sorting
+    # makes the chunks deterministic which is required to resume from an
+    # accumulator
+    svoxels = np.unique(np.concatenate([np.asarray(roots2svxl[i], dtype=np.int64)
+                                        for i in ids]))
+    svoxels_hash = hashlib.sha1(svoxels.tobytes()).hexdigest()
+    chunksize = int(chunksize)
+    n_chunks = max(int(np.ceil(len(svoxels) / chunksize)), 1)
+
+    # Running sums
+    sums = np.zeros((len(ids), len(trans)), dtype=np.float64)
+    weights = np.zeros(len(ids), dtype=np.float64)
+    done = np.zeros(n_chunks, dtype=bool)
+
+    if accumulator:
+        accumulator = Path(accumulator).expanduser()
+        if accumulator.is_file():
+            with np.load(accumulator) as acc:
+                if not np.array_equal(acc['ids'], ids) \
+                   or acc['chunksize'] != chunksize \
+                   or 'svoxels_hash' not in acc \
+                   or str(acc['svoxels_hash']) != svoxels_hash:
+                    raise ValueError(f'Accumulator "{accumulator}" was generated '
+                                     'for different neurons, supervoxels or '
+                                     'chunksize.')
+                sums, weights, done = acc['sums'], acc['weights'], acc['done']
+
+    backend = get_synapse_backend()
+    for i in navis.config.tqdm(np.where(~done)[0],
+                               desc='Predicting',
+                               disable=not progress or n_chunks == 1,
+                               leave=False):
+        chunk = svoxels[i * chunksize: (i + 1) * chunksize]
+        syn = backend.get_connectivity(chunk,
+                                       segmentation='flywire_supervoxels',
+                                       nt_predictions=True,
+                                       as_arrow=True)
+
+        syn_pre = syn.column('pre').to_numpy().astype(np.int64, copy=False)
+        syn_post = syn.column('post').to_numpy().astype(np.int64, copy=False)
+        pred = np.column_stack([syn.column(t).to_numpy() for t in trans])
+        w = syn.column('cleft_scores').to_numpy().astype(np.float64)
+
+        # Keep presynapses of this chunk that have a prediction
+        keep = np.isin(syn_pre, chunk) & (syn_post != 0)
+        keep &= np.any(pred != 0, axis=1)
+
+        # Map presynaptic supervoxels -> roots -> index in `ids`
+        ix = np.searchsorted(ids, _map_ids(syn_pre[keep], keys, values))
+
+        w = w[keep]
+        pred = pred[keep]
+        weights += np.bincount(ix, weights=w, minlength=len(ids))
+        for k in range(len(trans)):
+            sums[:, k] += np.bincount(ix, weights=pred[:, k] * w, minlength=len(ids))
+
+        done[i] = True
+
+        if accumulator:
+            _save_accumulator(accumulator, ids=ids, chunksize=chunksize,
+                              svoxels_hash=svoxels_hash,
+                              sums=sums, weights=weights, done=done)
+
+    conf = nt_confidence(sums, weights)
+
+    if single_pred:
+        top_ix = np.argmax(conf, axis=1)
+        top_conf = conf[np.arange(len(ids)), top_ix]
+        return {i: (trans[t], c) for i, t, c in zip(ids, top_ix, top_conf)}
+
+    return pd.DataFrame(conf.T, index=trans, columns=ids)
+
+
+def _save_accumulator(filepath, **kwargs):
+    """Save accumulator arrays without leaving a broken file on interrupt."""
+    tmp = filepath.parent / f'{filepath.name}.tmp'
+    with open(tmp, 'wb') as f:
+        np.savez(f, **kwargs)
+    os.replace(tmp, filepath)
+
+
 def fetch_synapses(x, pre=True, post=True, attach=True, min_score=0,
-                   dataset='production', transmitters=False, progress=True):
+                   dataset='production', transmitters=False, max_threads=4,
+                   progress=True):
     """Fetch Buhmann et al. (2019) synapses for given neuron(s).
 
     Uses a service on spine.janelia.org hosted by Eric Perlman and Davi Bock.
@@ -103,6 +287,9 @@ def fetch_synapses(x, pre=True, post=True, attach=True, min_score=0,
                     Against which flywire dataset to query::
                         - "production" (current production dataset, fly_v31)
                         - "sandbox" (i.e. fly_v26)
+    max_threads :   int
+                    Number of threads to use for mapping synapses to nodes
+                    if ``attach=True``.
 
     Returns
     -------
@@ -127,82 +314,71 @@ def fetch_synapses(x, pre=True, post=True, attach=True, min_score=0,
     # Turn dict into array of supervoxels
     svoxels = np.concatenate(list(roots2svxl.values()))
 
-    # Query the synapses
-    syn = spine.synapses.get_connectivity(svoxels,
-                                          locations=True,
-                                          nt_predictions=transmitters,
-                                          segmentation='flywire_supervoxels')
+    # Query the synapses - we keep this as Arrow table until the very end
+    backend = get_synapse_backend()
+    syn = backend.get_connectivity(svoxels,
+                                   locations=True,
+                                   nt_predictions=transmitters,
+                                   segmentation='flywire_supervoxels',
+                                   as_arrow=True)
+    syn_pre = syn.column('pre').to_numpy().astype(np.int64, copy=False)
+    syn_post = syn.column('post').to_numpy().astype(np.int64, copy=False)
 
     # Next we need to run some clean-up:
-    # 1. Drop below threshold connections
+    # 1. Drop connections involving 0 (background, glia)
+    keep = (syn_pre != 0) & (syn_post != 0)
+    # 2. Drop below threshold connections
     if min_score:
-        syn = syn[syn.cleft_scores >= min_score]
-    # 2. Drop connections involving 0 (background, glia)
-    syn = syn[(syn.pre != 0) & (syn.post != 0)]
-
-    # Avoid copy warning
-    syn = syn.copy()
+        keep &= syn.column('cleft_scores').to_numpy() >= min_score
+    keep = np.where(keep)[0]
 
     # Now map the supervoxels to root IDs
-    svoxels = np.unique(syn[['pre', 'post']].values.flatten())
-    roots = supervoxels_to_roots(svoxels, dataset=dataset)
-
-    dct = dict(zip(svoxels, roots))
-
-    # If any of the query root IDs are outdated, we have to make sure that
-    # we still map their supervoxels to their root ID and not the current
-    # root
-    dct.update({v: r for r in roots2svxl for v in roots2svxl[r]})
-
-    syn['pre'] = syn.pre.map(dct)
-    syn['post'] = syn.post.map(dct)
+    roots_pre, roots_post = _supervoxels_to_roots(syn_pre[keep],
+                                                  syn_post[keep],
+                                                  roots2svxl=roots2svxl,
+                                                  dataset=dataset)
 
+    # 3. Drop synapses not involving the query neurons as pre/post
+    is_query = np.ones(len(keep), dtype=bool)
     if not pre:
-        # Drop synapses where `post` is not in query IDs
-        syn = syn[syn.post.isin(ids)].copy()
+        is_query &= np.isin(roots_post, ids)
     if not post:
-        # Drop synapses where `pre` is not in query IDs
-        syn = syn[syn.pre.isin(ids)].copy()
+        is_query &= np.isin(roots_pre, ids)
+
+    # Apply filters and swap in root IDs in one go
+    syn = syn.take(pa.array(keep[is_query]))
+    syn = syn.set_column(syn.schema.get_field_index('pre'), 'pre',
+                         pa.array(roots_pre[is_query]))
+    syn = syn.set_column(syn.schema.get_field_index('post'), 'post',
+                         pa.array(roots_post[is_query]))
+    syn = syn.to_pandas()
 
     if attach and isinstance(x, navis.NeuronList):
-        for n in x:
-            presyn = postsyn = pd.DataFrame([])
-            if pre:
-                presyn = syn.loc[syn.pre == int(n.id),
-                                 ['pre_x', 'pre_y', 'pre_z',
-                                  'cleft_scores', 'post']].rename({'pre_x': 'x',
-                                                                   'pre_y': 'y',
-                                                                   'pre_z': 'z',
-                                                                   'post': 'partner_id'},
-                                                                  axis=1)
-                presyn['type'] = 'pre'
-            if post:
-                postsyn = syn.loc[syn.post == int(n.id),
-                                  ['post_x', 'post_y', 'post_z',
-                                   'cleft_scores', 'pre']].rename({'post_x': 'x',
-                                                                   'post_y': 'y',
-                                                                   'post_z': 'z',
-                                                                   'pre': 'partner_id'},
-                                                                  axis=1)
-                postsyn['type'] = 'post'
-
-            connectors = pd.concat((presyn, postsyn), axis=0, ignore_index=True)
-
-            # Turn type column into categorical to save memory
-            connectors['type'] = connectors['type'].astype('category')
-
-            # If TreeNeuron, map each synapse to a node
-            if isinstance(n, navis.TreeNeuron):
-                tree = navis.neuron2KDTree(n, data='nodes')
-                dist, ix = tree.query(connectors[['x', 'y', 'z']].values)
-                connectors['node_id'] = n.nodes.node_id.values[ix]
-
-            n.connectors = connectors
+        # Partition synapses by neuron once instead of scanning the table
+        # for every neuron
+        owners, connectors = _partition_connectors(syn, pre=pre, post=post)
+        ids = np.array([int(n.id) for n in x], dtype=np.int64)
+        left = np.searchsorted(owners, ids, side='left')
+        right = np.searchsorted(owners, ids, side='right')
+
+        cn = [connectors.iloc[l:h].reset_index(drop=True) for l, h in zip(left, right)]
+
+        # If TreeNeurons, map each synapse to a node
+        is_tn = [i for i, n in enumerate(x) if isinstance(n, navis.TreeNeuron)]
+        res = closest_nodes([x[i] for i in is_tn],
+                            [cn[i][['x', 'y', 'z']].values for i in is_tn],
+                            max_threads=max_threads)
+        for i, (dist, ix) in zip(is_tn, res):
+            cn[i]['node_id'] = x[i].nodes.node_id.values[ix]
+
+        for n, c in zip(x, cn):
+            n.connectors = c
 
     return syn
 
 
-def fetch_adjacency(sources, targets=None, min_score=30, dataset='production',
+def fetch_adjacency(sources, targets=None, min_score=30, sparse=False,
+                    block_size=50000, filepath=None, dataset='production',
                     progress=True):
     """Fetch adjacency matrix.
 
@@ -223,6 +399,21 @@ def fetch_adjacency(sources, targets=None, min_score=30, dataset='production',
     min_score :     int
                     Minimum "cleft score". The default of 30 is what Buhmann et al.
                     used in the paper.
+    sparse :        bool
+                    If True, will return a ``scipy.sparse.csr_matrix`` plus the
+                    source and target IDs instead of a dense DataFrame. Use
+                    this for large sets of neurons.
+    block_size :    int | None
+                    Synapses are queried and aggregated in blocks of this many
+                    supervoxels. This bounds the memory footprint: the full
+                    synapse table never exists at once. If None, will query
+                    all supervoxels in one go.
+    filepath :      str, optional
+                    If provided, will write the adjacency to this file
+                    (``.npz``). The file can be read with
+                    ``scipy.sparse.load_npz``; source and target IDs are
+                    stored alongside as ``sources`` and ``targets`` (use
+                    ``numpy.load``).
     dataset :       str | CloudVolume
                     Against which flywire dataset to query::
                         - "production" (current production dataset, fly_v31)
@@ -231,8 +422,17 @@ def fetch_adjacency(sources, targets=None, min_score=30, dataset='production',
     Returns
     -------
     adjacency :     pd.DataFrame
-                    Adjacency matrix. Rows (sources) and columns (targets) are
-                    in the same order as input.
+                    If ``sparse=False``: adjacency matrix. Rows (sources) and
+                    columns (targets) are in the same order as input.
+    (adjacency, sources, targets)
+                    If ``sparse=True``: CSR matrix and arrays of root IDs for
+                    its rows and columns, respectively.
+
+    Examples
+    --------
+    >>> from fafbseg import flywire
+    >>> adj, sources, targets = flywire.fetch_adjacency(ids, sparse=True,
+    ...                                                 filepath='adj.npz')
 
     """
     if isinstance(targets, type(None)):
@@ -261,39 +461,66 @@ def fetch_adjacency(sources, targets=None, min_score=30, dataset='production',
 
     # Map queries to supervoxels
     query_svoxels = np.concatenate([roots2svxl[q] for q in query])
-
-    # Query the synapses by supervoxels
-    syn = spine.synapses.get_connectivity(query_svoxels,
-                                          locations=False,
-                                          nt_predictions=False,
-                                          segmentation='flywire_supervoxels')
-
-    # Drop below-threshold synapses
-    syn = syn[syn.cleft_scores >= min_score]
-
-    # Flip roots to supervoxels dict
-    svxl2roots = {sv: r for r in roots2svxl for sv in roots2svxl[r]}
-
-    # Drop any synapse that does not involve source and targets
-    # Do not change the way this mapping is one - there is something funny
-    # going on with data types usin the usual `syn.pre.isin(svxl2roots)` that
-    # leads to values incorrectly being assumed to be True
-    syn['pre'] = syn.pre.map(lambda x: svxl2roots.get(x, 0)).astype(np.int64)
-    syn['post'] = syn.post.map(lambda x: svxl2roots.get(x, 0)).astype(np.int64)
-    syn = syn[(syn.pre != 0) & (syn.post != 0)]
-    syn = syn[syn.pre.isin(sources) & syn.post.isin(targets)]
-
-    # Aggregate
-    cn = syn.groupby(['pre', 'post']).size().reset_index(drop=False)
-    cn.columns = ['source', 'target', 'weight']
-
-    # Pivot
-    adj = cn.pivot(index='source', columns='target', values='weight').fillna(0)
-
-    # Index to match order and add any missing neurons
-    adj = adj.reindex(index=sources, columns=targets).fillna(0)
-
-    return adj
+    if not block_size:
+        block_size = max(len(query_svoxels), 1)
+
+    # Query the synapses by supervoxels - block by block
+    backend = get_synapse_backend()
+    blocks = backend.get_connectivity(query_svoxels,
+                                      locations=False,
+                                      nt_predictions=False,
+                                      segmentation='flywire_supervoxels',
+                                      chunksize=block_size,
+                                      iterator=True,
+                                      as_arrow=True,
+                                      progress=progress)
+
+    # Look-up tables: supervoxels -> roots -> rows (sources)/columns (targets)
+    keys, values = _svxl_lookup(roots2svxl)
+    sources_u = np.unique(sources)
+    targets_u = np.unique(targets)
+    shape = (len(sources_u), len(targets_u))
+
+    adj = sp.csr_matrix(shape, dtype=np.float64)
+    for syn in blocks:
+        # Anything that is not one of our sources/targets will be 0 -> -1
+        pre = _map_ids(syn.column('pre').to_numpy(), keys, values)
+        post = _map_ids(syn.column('post').to_numpy(), keys, values)
+        rows = _map_ids(pre, sources_u, np.arange(shape[0]), default=-1)
+        cols = _map_ids(post, targets_u, np.arange(shape[1]), default=-1)
+
+        # Drop below-threshold synapses and those not between sources and targets
+        keep = (rows >= 0) & (cols >= 0)
+        keep &= syn.column('cleft_scores').to_numpy() >= min_score
+
+        # Aggregate - duplicate (row, col) entries are summed up
+        adj += sp.coo_matrix((np.ones(keep.sum()), (rows[keep], cols[keep])),
+                             shape=shape).tocsr()
+
+    # Reorder rows and columns to match input (this also takes care of
+    # duplicate IDs)
+    adj = adj[np.searchsorted(sources_u, sources)][:, np.searchsorted(targets_u, targets)]
+
+    if filepath:
+        _save_adjacency(filepath, adj, sources, targets)
+
+    if sparse:
+        return adj, sources, targets
+
+    return pd.DataFrame(adj.toarray(), index=sources, columns=targets)
+
+
+def _save_adjacency(filepath, adj, sources, targets):
+    """Save sparse adjacency + IDs in ``scipy.sparse.save_npz`` format."""
+    adj = adj.tocsr()
+    np.savez_compressed(filepath,
+                        format=b'csr',
+                        shape=adj.shape,
+                        data=adj.data,
+                        indices=adj.indices,
+                        indptr=adj.indptr,
+                        sources=sources,
+                        targets=targets)
 
 
 def fetch_connectivity(x, clean=True, style='catmaid', min_score=30,
@@ -367,12 +594,15 @@ def fetch_connectivity(x, clean=True, style='catmaid', min_score=30,
     # (this is a dict)
     roots2svxl = roots_to_supervoxels(ids, dataset=dataset, progress=progress)
     # Turn dict into array of supervoxels
-    svoxels = np.concatenate(list(roots2svxl.values()))
+    svoxels = np.concatenate(list(roots2svxl.values())).astype(np.int64, copy=False)
 
     # Query the synapses
-    syn = spine.synapses.get_connectivity(svoxels,
-                                          segmentation='flywire_supervoxels',
-                                          nt_predictions=transmitters)
+    backend = get_synapse_backend()
+    syn = backend.get_connectivity(svoxels,
+                                   segmentation='flywire_supervoxels',
+                                   nt_predictions=transmitters)
+    syn['pre'] = syn.pre.astype(np.int64, copy=False)
+    syn['post'] = syn.post.astype(np.int64, copy=False)
 
     if not upstream:
         syn = syn[~syn.post.isin(svoxels)]
@@ -390,18 +620,10 @@ def fetch_connectivity(x, clean=True, style='catmaid', min_score=30,
     syn = syn.copy()
 
     # Now map the supervoxels to root IDs
-    svoxels = np.unique(syn[['pre', 'post']].values.flatten())
-    roots = supervoxels_to_roots(svoxels, dataset=dataset)
-
-    dct = dict(zip(svoxels, roots))
-
-    # If any of the query root IDs are outdated, we have to make sure that
-    # we still map their supervoxels to their root ID and not the current
-    # root
-    dct.update({v: r for r in roots2svxl for v in roots2svxl[r]})
-
-    syn['pre'] = syn.pre.map(dct)
-    syn['post'] = syn.post.map(dct)
+    syn['pre'], syn['post'] = _supervoxels_to_roots(syn.pre.values,
+                                                    syn.post.values,
+                                                    roots2svxl=roots2svxl,
+                                                    dataset=dataset)
 
     # Turn into connectivity table
     cn_table = syn.groupby(['pre', 'post'], as_index=False).size().rename({'size': 'weight'}, axis=1)
@@ -420,3 +642,115 @@ def fetch_connectivity(x, clean=True, style='catmaid', min_score=30,
         cn_table['pred_conf'] = cn_table.pre.map(lambda x: pred.get(x, [None, None])[1])
 
     return cn_table
+
+
+def _supervoxels_to_roots(pre, post, roots2svxl, dataset='production'):
+    """Map pre- and postsynaptic supervoxels to root IDs.
+
+    Supervoxels of the query roots are mapped via ``roots2svxl`` - all other
+    supervoxels are looked up once (in the materialized roots if available,
+    see :func:`~fafbseg.flywire.materialize_roots`) and mapped via
+    ``np.searchsorted``.
+
+    Parameters
+    ----------
+    pre, post :     np.ndarray
+                    Arrays of supervoxel IDs.
+    roots2svxl :    dict
+                    ``{root_id: supervoxels}`` for the query neurons.
+    dataset :       str | CloudVolume
+                    Against which flywire dataset to query.
+
+    Returns
+    -------
+    roots_pre, roots_post :     np.ndarray
+                                Arrays (int64) of root IDs.
+
+    """
+    # Backends return uint64 - mixing that with int64 would make numpy cast
+    # to float64 and lose precision for realistic supervoxel IDs
+    pre = np.asarray(pre).astype(np.int64, copy=False)
+    post = np.asarray(post).astype(np.int64, copy=False)
+
+    # Supervoxels of the query neurons
+    q_svxl, q_roots = _svxl_lookup(roots2svxl)
+
+    # Look up the remaining supervoxels - use materialized roots if possible
+    svoxels = np.unique(np.concatenate((pre, post)))
+    svoxels = svoxels[~np.isin(svoxels, q_svxl)]
+    mat = get_materialization(dataset)
+    if mat is not None:
+        roots, found = mat.lookup(svoxels)
+        roots = roots.astype(np.int64, copy=False)
+    else:
+        roots, found = np.zeros(len(svoxels), dtype=np.int64), np.zeros(len(svoxels), dtype=bool)
+    if not np.all(found):
+        roots[~found] = np.asarray(supervoxels_to_roots(svoxels[~found],
+                                                        dataset=dataset),
+                                   dtype=np.int64)
+
+    # Build a sorted look-up table
+    keys = np.concatenate((q_svxl, svoxels))
+    values = np.concatenate((q_roots, roots))
+    keys, ix = np.unique(keys, return_index=True)
+    values = values[ix]
+
+    return _map_ids(pre, keys, values), _map_ids(post, keys, values)
+
+
+def _svxl_lookup(roots2svxl):
+    """Turn ``{root_id: supervoxels}`` into sorted (supervoxels, roots) arrays."""
+    svxl = np.concatenate([np.asarray(v, dtype=np.int64) for v in roots2svxl.values()])
+    roots = np.repeat(np.array(list(roots2svxl.keys()), dtype=np.int64),
+                      [len(v) for v in roots2svxl.values()])
+
+    srt = np.argsort(svxl, kind='stable')
+    return svxl[srt], roots[srt]
+
+
+def _map_ids(x, keys, values, default=0):
+    """Map ``x`` from (sorted) ``keys`` to ``values``."""
+    x = np.asarray(x).astype(keys.dtype, copy=False)
+    if not len(keys):
+        return np.full(x.shape, default, dtype=values.dtype)
+
+    ix = np.searchsorted(keys, x)
+    ix[ix >= len(keys)] = 0
+    return np.where(keys[ix] == x, values[ix], default)
+
+
+def _partition_connectors(syn, pre=True, post=True):
+    """Turn synapse table into connector table sorted by neuron.
+
+    Returns
+    -------
+    owners :        np.ndarray
+                    Sorted root ID of the neuron each connector belongs to.
+    connectors :    pandas.DataFrame
+                    Connector table (x, y, z, cleft_scores, partner_id, type)
+                    in the same order as ``owners``.
+
+    """
+    tables, owners = [], []
+    if pre:
+        presyn = syn[['pre_x', 'pre_y', 'pre_z', 'cleft_scores', 'post']]
+        presyn.columns = ['x', 'y', 'z', 'cleft_scores', 'partner_id']
+        tables.append(presyn.assign(type='pre'))
+        owners.append(syn.pre.values)
+    if post:
+        postsyn = syn[['post_x', 'post_y', 'post_z', 'cleft_scores', 'pre']]
+        postsyn.columns = ['x', 'y', 'z', 'cleft_scores', 'partner_id']
+        tables.append(postsyn.assign(type='post'))
+        owners.append(syn.post.values)
+
+    connectors = pd.concat(tables, axis=0, ignore_index=True)
+    owners = np.concatenate(owners)
+
+    # Turn type column into categorical to save memory
+    connectors['type'] = connectors['type'].astype('category')
+
+    # Stable sort keeps presynapses before postsynapses for each neuron
+    srt = np.argsort(owners, kind='stable')
+
+    return owners[srt], connectors.iloc[srt]
+
@@ -16,7 +16,6 @@
 """DEPRECATED module."""
 
 import cloudvolume
-import collections
 import numpy as np
 import pandas as pd
 import os
@@ -27,6 +26,7 @@ from concurrent import futures
 
 from .. import utils
 from .. import spine
+from ..volumes import group_by_chunk
 
 CVtype = cloudvolume.frontends.precomputed.CloudVolumePrecomputed
 
@@ -55,8 +55,7 @@ class GSPointLoader(object):
             raise TypeError('Expected CloudVolume, got "{}"'.format(type(cloud_volume)))
 
         self._volume = cloud_volume
-        self._chunk_map = collections.defaultdict(set)
-        self._points = None
+        self._points = np.zeros((0, 3))
 
     def add_points(self, points):
         """Add more points to be loaded.
@@ -68,18 +67,8 @@ class GSPointLoader(object):
                     to volume.scale['resolution'].
 
         """
-        points = np.asarray(points)
-
-        if isinstance(self._points, type(None)):
-            self._points = points
-        else:
-            self._points = np.concat(self._points, points)
-
-        resolution = np.array(self._volume.scale['resolution'])
-        chunk_size = np.array(self._volume.scale['chunk_sizes'])
-        chunk_starts = (points // resolution).astype(int) // chunk_size * chunk_size
-        for point, chunk_start in zip(points, chunk_starts):
-            self._chunk_map[tuple(chunk_start)].add(tuple(point))
+        points = np.asarray(points).reshape(-1, 3)
+        self._points = np.concatenate((self._points, points), axis=0)
 
     def _load_chunk(self, chunk_start, chunk_end):
         # (No validation that this is a valid chunk_start.)
@@ -87,24 +76,15 @@ class GSPointLoader(object):
                             chunk_start[1]:chunk_end[1],
                             chunk_start[2]:chunk_end[2]]
 
-    def _load_points(self, chunk_map_key):
-        chunk_start = np.array(chunk_map_key)
-        points = np.array(list(self._chunk_map[chunk_map_key]))
-
-        resolution = np.array(self._volume.scale['resolution'])
-        indices = (points // resolution).astype(int) - chunk_start
-
+    def _load_points(self, indices):
         # We don't really need to load the whole chunk here:
         # Instead, we subset the chunk to the part that contains our points
         # This should at the very least save memory
         mn, mx = indices.min(axis=0), indices.max(axis=0)
 
-        chunk_end = chunk_start + mx + 1
-        chunk_start += mn
-        indices -= mn
-
-        chunk = self._load_chunk(chunk_start, chunk_end)
-        return points, chunk[indices[:, 0], indices[:, 1], indices[:, 2]]
+        chunk = self._load_chunk(mn, mx + 1)
+        indices = indices - mn
+        return chunk[indices[:, 0], indices[:, 1], indices[:, 2]]
 
     def load_all(self, max_workers=4, return_sorted=True, progress=True):
         """Load all points in current list, batching by storage chunk.
@@ -128,29 +108,44 @@ class GSPointLoader(object):
                         data loaded from volume.
 
         """
+        resolution = np.array(self._volume.scale['resolution'])
+        chunk_size = np.array(self._volume.scale['chunk_sizes']).reshape(-1, 3)[0]
+        offset = np.array(self._volume.scale.get('voxel_offset', [0, 0, 0]))
+
+        vxl = (self._points // resolution).astype(np.int64)
+        if not len(vxl):
+            return self._points, np.zeros(0, dtype=self._volume.dtype)
+
+        # Group points by storage chunk (chunks are aligned to voxel offset)
+        _, groups = group_by_chunk(vxl - offset, chunk_size)
+
         progress_state = self._volume.progress
         self._volume.progress = False
-        with tqdm.tqdm(total=len(self._chunk_map),
-                       desc='Segmentation IDs',
-                       leave=False,
-                       disable=not progress) as pbar:
-            with futures.ProcessPoolExecutor(max_workers=max_workers) as ex:
-                point_futures = [ex.submit(self._load_points, k) for k in self._chunk_map]
-                for f in futures.as_completed(point_futures):
-                    pbar.update(1)
-        self._volume.progress = progress_state
+        try:
+            with tqdm.tqdm(total=len(groups),
+                           desc='Segmentation IDs',
+                           leave=False,
+                           disable=not progress) as pbar:
+                # Threads instead of processes: the volume is not pickled
+                with futures.ThreadPoolExecutor(max_workers=max_workers) as ex:
+                    point_futures = [ex.submit(self._load_points, vxl[ix]) for ix in groups]
+                    for f in futures.as_completed(point_futures):
+                        pbar.update(1)
+        finally:
+            self._volume.progress = progress_state
 
         results = [f.result() for f in point_futures]
+        order = np.concatenate(groups)
+        values = np.concatenate(results)
 
         if return_sorted:
-            points_dict = dict(zip([tuple(p) for result in results for p in result[0]],
-                                   [i for result in results for i in result[1]]))
-
-            data = np.array([points_dict[tuple(p)] for p in self._points])
+            # Scatter results back to the order in which points were added
+            data = np.empty_like(values)
+            data[order] = values
             points = self._points
         else:
-            points = np.concatenate([result[0] for result in results])
-            data = np.concatenate([result[1] for result in results])
+            points = self._points[order]
+            data = values
 
         return points, data
 
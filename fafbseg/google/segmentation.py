@@ -23,18 +23,74 @@ import trimesh as tm
 from tqdm.auto import tqdm
 
 from .. import utils, move, spine
+from ..volumes import LocalVolume
 use_pbars = utils.use_pbars
 
 __all__ = ['segments_to_neuron', 'segments_to_skids', 'neuron_to_segments',
            'find_autoseg_fragments', 'find_fragments', 'find_missed_branches',
-           'locs_to_segments']
+           'locs_to_segments', 'use_local_segmentation',
+           'use_spine_segmentation']
+
+# Local copy of the segmentation (None if using spine)
+LOCAL_SEGMENTATION = None
+
+
+def use_local_segmentation(path, mip=0, dataset='fafb-ffn1-20200412',
+                           cache_size=256, max_threads=4, **kwargs):
+    """Use a local copy of the segmentation for :func:`locs_to_segments`.
+
+    Parameters
+    ----------
+    path :          str | CloudVolume
+                    Path to the local copy (directory with the ``info`` file).
+    mip :           int
+                    Scale to query. :func:`locs_to_segments` will raise an
+                    error if asked for a different mip.
+    dataset :       str
+                    Which segmentation this is a copy of.
+                    :func:`locs_to_segments` will raise an error if asked for
+                    a different dataset.
+    cache_size :    int
+                    Max number of decoded chunks to keep in memory.
+    max_threads :   int
+                    Number of threads used to decode chunks.
+    **kwargs
+                    Keyword arguments passed on to ``cloudvolume.CloudVolume``.
+
+    Returns
+    -------
+    None
+
+    Examples
+    --------
+    >>> from fafbseg import google
+    >>> google.use_local_segmentation('/Volumes/SSD/fafb-ffn1-20200412')
+
+    See Also
+    --------
+    :func:`~fafbseg.google.use_spine_segmentation`
+                    Switch back to the spine web service.
+
+    """
+    global LOCAL_SEGMENTATION
+    LOCAL_SEGMENTATION = LocalVolume(path, mip=mip, cache_size=cache_size,
+                                     max_threads=max_threads, dataset=dataset,
+                                     **kwargs)
+
+
+def use_spine_segmentation():
+    """Use the spine web service to look up segment IDs (default)."""
+    global LOCAL_SEGMENTATION
+    LOCAL_SEGMENTATION = None
 
 
 def locs_to_segments(locs, mip=0, dataset='fafb-ffn1-20200412',
                      coordinates='voxel'):
     """Retrieve Google segmentation IDs at given location(s).
 
-    Uses a service on hosted spine.janelia.org by Eric Perlman and Davi Bock.
+    Uses a service on hosted spine.janelia.org by Eric Perlman and Davi Bock
+    unless a local copy of the segmentation has been set via
+    :func:`~fafbseg.google.use_local_segmentation`.
 
     Parameters
     ----------
@@ -58,6 +114,17 @@ def locs_to_segments(locs, mip=0, dataset='fafb-ffn1-20200412',
                 locations will be returned with ID 0.
 
     """
+    if LOCAL_SEGMENTATION is not None:
+        if dataset != LOCAL_SEGMENTATION.dataset:
+            raise ValueError(f'Local segmentation is "{LOCAL_SEGMENTATION.dataset}"'
+                             f', not "{dataset}". Use '
+                             '`google.use_spine_segmentation()` to query other '
+                             'datasets.')
+        if mip != LOCAL_SEGMENTATION.mip:
+            raise ValueError(f'Local segmentation is at mip {LOCAL_SEGMENTATION.mip}'
+                             f', not {mip}.')
+        return LOCAL_SEGMENTATION.lookup(locs, coordinates=coordinates)
+
     return spine.transform.get_segids(locs, segmentation=dataset,
                                       coordinates=coordinates, mip=mip)
 
@@ -221,25 +288,36 @@ def segments_to_skids(seg_ids, autoseg_instance, name_pattern="Google: {id}",
     return seg2skid
 
 
-def neuron_to_segments(x):
+def neuron_to_segments(x, sparse=False):
     """Get segment IDs overlapping with a given neuron.
 
     Parameters
     ----------
     x :                 Neuron/List
                         Neurons for which to return segment IDs.
+    sparse :            bool
+                        If True, will return a sparse table of (skeleton ID,
+                        segment ID, counts) instead of a dense matrix. Use
+                        this for large lists of neurons.
 
     Returns
     -------
     overlap_matrix :    pandas.DataFrame
-                        DataFrame of segment IDs (rows) and IDs
-                        (columns) with overlap in nodes as values::
+                        If ``sparse=False``: DataFrame of segment IDs (rows)
+                        and IDs (columns) with overlap in nodes as values::
 
                             skeleton_id  id  3245
                             seg_id
                             10336680915   5     0
                             10336682132   0     1
 
+                        If ``sparse=True``: DataFrame with one row per
+                        overlapping neuron and segment::
+
+                               skeleton_id       seg_id  counts
+                            0           16  10336680915       5
+                            1         3245  10336682132       1
+
     """
     if isinstance(x, navis.TreeNeuron):
         x = navis.NeuronList(x)
@@ -253,18 +331,16 @@ def neuron_to_segments(x):
     nodes['seg_id'] = locs_to_segments(nodes[['x', 'y', 'z']].values,
                                        coordinates='nm', mip=0)
 
-    # Count segment IDs
-    seg_counts = nodes.groupby(['neuron', 'seg_id'], as_index=False).node_id.count()
-    seg_counts.columns = ['skeleton_id', 'seg_id', 'counts']
+    # Count segment IDs (ignores seg IDs 0)
+    seg_counts = utils.overlap_counts(nodes.neuron.values, nodes.seg_id.values,
+                                      id_col='skeleton_id', seg_col='seg_id')
 
-    # Remove seg IDs 0
-    seg_counts = seg_counts[seg_counts.seg_id != 0]
+    if sparse:
+        return seg_counts
 
     # Turn into matrix where columns are skeleton IDs, segment IDs are rows
     # and values are the overlap counts
-    matrix = seg_counts.pivot(index='seg_id', columns='skeleton_id', values='counts')
-
-    return matrix
+    return utils.overlap_matrix(seg_counts, id_col='skeleton_id', seg_col='seg_id')
 
 
 def find_autoseg_fragments(x, autoseg_instance, min_node_overlap=3, min_nodes=1,
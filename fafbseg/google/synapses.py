@@ -93,12 +93,9 @@ def fetch_connectivity(x, segmentation='fafb-ffn1-20200412', clean=True, style='
     # First we need to map the query to IDs
     if isinstance(x, (navis.TreeNeuron, navis.NeuronList)):
         # Get segments overlapping with these neurons
-        overlaps = neuron_to_segments(x)
+        overlaps = neuron_to_segments(x, sparse=True)
 
-        ids = {}
-        for n in overlaps.columns:
-            this = overlaps[overlaps[n] > 0][n]
-            ids.update(dict(zip(this.index.values, [n] * this.shape[0])))
+        ids = dict(zip(overlaps.seg_id.values, overlaps.skeleton_id.values))
     elif isinstance(x, (int, np.int)):
         ids = {x: x}
     else:
@@ -14,20 +14,98 @@
 #    GNU General Public License for more details.
 """Collection of functions to query data from spine."""
 
+import collections
 import navis
 import requests
+import time
 import warnings
 
 import cloudvolume as cv
 import numpy as np
-import pandas as pd
+import pyarrow as pa
 import trimesh as tm
 
 from abc import ABC
-from io import StringIO, BytesIO
+from concurrent import futures
+from diskcache import Cache
+from pyarrow import feather
 
 use_pbars = True
 
+# Meta data (available datasets, collections, etc.) is persisted to disk and
+# considered fresh for this many seconds. After that, we revalidate with the
+# server using ETag/Last-Modified headers.
+METADATA_CACHE = '~/.fafbseg/spine_cache/'
+METADATA_TTL = 24 * 60 * 60
+
+
+def fetch_json(url, session=None, ttl=None, use_cache=True):
+    """Fetch JSON from given URL using a persistent cache.
+
+    Parameters
+    ----------
+    url :           str
+                    URL to fetch.
+    session :       requests.Session, optional
+                    Session to use for the request.
+    ttl :           int, optional
+                    Time in seconds for which cached data is used without
+                    asking the server. Defaults to ``METADATA_TTL``.
+    use_cache :     bool
+                    If False, will bypass the cache.
+
+    Returns
+    -------
+    dict | list
+
+    """
+    if session is None:
+        session = requests
+
+    if not use_cache:
+        resp = session.get(url)
+        resp.raise_for_status()
+        return resp.json()
+
+    if ttl is None:
+        ttl = METADATA_TTL
+
+    with Cache(directory=METADATA_CACHE) as cache:
+        cached = cache.get(url, None)
+
+        # Use cached data if it's still fresh
+        if cached and (time.time() - cached['time']) < ttl:
+            return cached['data']
+
+        # Ask server if cached data is still valid
+        headers = {}
+        if cached and cached.get('etag'):
+            headers['If-None-Match'] = cached['etag']
+        if cached and cached.get('last_modified'):
+            headers['If-Modified-Since'] = cached['last_modified']
+
+        try:
+            resp = session.get(url, headers=headers)
+            if resp.status_code != 304:
+                resp.raise_for_status()
+        except requests.exceptions.RequestException:
+            # If we can't reach the server, fall back to stale data
+            if not cached:
+                raise
+            warnings.warn(f'Unable to reach {url} - using cached meta data.')
+            return cached['data']
+
+        if resp.status_code == 304:
+            cached['time'] = time.time()
+        else:
+            cached = {'data': resp.json(),
+                      'etag': resp.headers.get('ETag', None),
+                      'last_modified': resp.headers.get('Last-Modified', None),
+                      'time': time.time()}
+        cache[url] = cached
+
+    return cached['data']
+
 
 class OnDemandDict(dict):
     """Initialized with a just a URL.
@@ -59,9 +137,7 @@ class OnDemandDict(dict):
 
     def update_from_url(self):
         """Update content from URL."""
-        resp = requests.get(self.url)
-        resp.raise_for_status()
-        self.update(resp.json())
+        self.update(fetch_json(self.url))
         self.fetched = True
 
 
@@ -80,9 +156,7 @@ def spine_transform_datasets():
     dict
 
     """
-    resp = requests.get(f'{TRANSFORM_SERVICE_URL}/info')
-    resp.raise_for_status()
-    return resp.json()
+    return fetch_json(f'{TRANSFORM_SERVICE_URL}/info', use_cache=False)
 
 
 class SpineService(ABC):
@@ -92,12 +166,26 @@ class SpineService(ABC):
     def info(self):
         """Return general info on given service."""
         if not hasattr(self, '_info'):
-            url = self.makeurl('info')
-            resp = self.session.get(url)
-            resp.raise_for_status()
-            self._info = resp.json()
+            self._info = self.get_metadata('info')
         return self._info
 
+    def get_metadata(self, *args):
+        """Fetch meta data from given endpoint.
+
+        Meta data is persisted on disk (see ``METADATA_TTL``) so that we don't
+        have to fetch it again in every new session.
+
+        """
+        return fetch_json(self.makeurl(*args), session=self.session)
+
+    def available(self, what):
+        """Return set of names for given list of meta data (e.g. "collections")."""
+        if not hasattr(self, '_available'):
+            self._available = {}
+        if what not in self._available:
+            self._available[what] = {c.get('name', 'NA') for c in getattr(self, what)}
+        return self._available[what]
+
     def urljoin(self, *args):
         """Join arguments into an url.
 
@@ -118,6 +206,7 @@ class FlyCacheService(SpineService):
                  base_url='https://services.itanna.io/app/flycache-dev'):
         """Init class."""
         self.base_url = base_url
+        self.session = requests.Session()
 
     def get_L2_centroids(self, ids, token, as_array=False, chunksize=50,
                          progress=True):
@@ -224,52 +313,43 @@ class SynapseService(SpineService):
     def alignments(self):
         """Return available alignments of synapse data."""
         if not hasattr(self, '_alignments'):
-            url = self.makeurl('alignments')
-            resp = self.session.get(url)
-            resp.raise_for_status()
-            self._alignments = resp.json()
+            self._alignments = self.get_metadata('alignments')
         return self._alignments
 
     @property
     def collections(self):
         """Return available collections of synapse data."""
         if not hasattr(self, '_collections'):
-            url = self.makeurl('collections')
-            resp = self.session.get(url)
-            resp.raise_for_status()
-            self._collections = resp.json()
+            self._collections = self.get_metadata('collections')
         return self._collections
 
     @property
     def segmentations(self):
         """Return available segmentations the synapse data is mapped to."""
         if not hasattr(self, '_segmentations'):
-            url = self.makeurl('segmentations')
-            resp = self.session.get(url)
-            resp.raise_for_status()
-            self._segmentations = resp.json()
+            self._segmentations = self.get_metadata('segmentations')
         return self._segmentations
 
     def validate_alignment(self, alignment):
         """Check if alignment exists."""
-        available = [c.get('name', 'NA') for c in self.alignments]
+        available = self.available('alignments')
         if alignment not in available:
             raise ValueError(f'{alignment} not among available alignments: '
-                             f'{",".join(available)}')
+                             f'{",".join(sorted(available))}')
 
     def validate_collection(self, collection):
         """Check if collection exists."""
-        available = [c.get('name', 'NA') for c in self.collections]
+        available = self.available('collections')
         if collection not in available:
             raise ValueError(f'{collection} not among available collections: '
-                             f'{",".join(available)}')
+                             f'{",".join(sorted(available))}')
 
     def validate_segmentation(self, segmentation):
         """Check if alignment exists."""
-        available = [c.get('name', 'NA') for c in self.segmentations]
+        available = self.available('segmentations')
         if segmentation not in available:
             raise ValueError(f'{segmentation} not among available segmentations: '
-                             f'{",".join(available)}')
+                             f'{",".join(sorted(available))}')
 
     def get_synapse(self, synapse_id, collection):
         """Return all available info (pre/post IDs, location) for single synapse.
@@ -299,9 +379,14 @@ class SynapseService(SpineService):
         return resp.json()
 
     def get_connectivity(self, segmentation_ids, segmentation, locations=False,
-                         nt_predictions=False):
+                         nt_predictions=False, chunksize=50000, max_threads=4,
+                         iterator=False, as_arrow=False, progress=False):
         """Fetch all connections from/to given segmentation ID(s).
 
+        Queries are split into chunks of ``chunksize`` IDs that are run in
+        parallel. Each response is parsed into an Arrow table without making
+        further copies.
+
         Parameters
         ----------
         segmentation_ids :  int | list thereof
@@ -318,10 +403,27 @@ class SynapseService(SpineService):
         nt_predictions :    bool
                             Whether to also fetch neurotransmitter predictions
                             for each synapses.
+        chunksize :         int
+                            Max number of IDs to query per request.
+        max_threads :       int
+                            Max number of parallel requests.
+        iterator :          bool
+                            If True, will return an iterator that yields one
+                            DataFrame per chunk of query IDs. Use this to keep
+                            the memory footprint bounded for very large
+                            queries.
+        as_arrow :          bool
+                            If True, will return ``pyarrow.Table`` instead of
+                            ``pandas.DataFrame``.
+        progress :          bool
+                            Whether to show a progress bar.
 
         Returns
         -------
-        pandas.DataFrame
+        pandas.DataFrame | pyarrow.Table
+                            If ``iterator=False``.
+        generator
+                            If ``iterator=True``.
 
         """
         # This always returns a numpy array
@@ -341,13 +443,111 @@ class SynapseService(SpineService):
         if param:
             url += f'?{"&".join(param)}'
 
-        post = {"query_ids": segmentation_ids.tolist()}
+        chunksize = int(chunksize)
+        chunks = [segmentation_ids[i: i + chunksize]
+                  for i in range(0, len(segmentation_ids), chunksize)]
 
-        resp = self.session.post(url, json=post)
-        resp.raise_for_status()
+        # We always want at least one query (even if empty) to get the columns
+        if not chunks:
+            chunks = [segmentation_ids]
+
+        tables = self._iter_feather(url, chunks,
+                                    max_threads=max_threads,
+                                    progress=progress)
+
+        # A synapse between IDs in different chunks is returned for each
+        # of these chunks -> only keep it for the first one
+        if len(chunks) > 1:
+            tables = _drop_repeats(tables, chunks)
+
+        if iterator:
+            if as_arrow:
+                return tables
+            return (t.to_pandas() for t in tables)
+
+        # Drop empty tables (unless all are empty) to avoid schema conflicts
+        tables = list(tables)
+        tables = [t for t in tables if t.num_rows] or tables[:1]
+        table = pa.concat_tables(tables)
+
+        if as_arrow:
+            return table
 
         # Read into DataFrame
-        return pd.read_feather(BytesIO(resp.content))
+        return table.to_pandas()
+
+    def _iter_feather(self, url, chunks, max_threads=4, progress=False):
+        """Post chunks of query IDs in parallel and yield Arrow tables.
+
+        Tables are yielded in the same order as the chunks. At most
+        ``max_threads`` responses are held in memory at any given time.
+
+        """
+        chunks = iter(chunks)
+        with navis.config.tqdm(desc='Fetching',
+                               leave=False,
+                               disable=not progress or not use_pbars) as pbar:
+            with futures.ThreadPoolExecutor(max_workers=max_threads) as pool:
+                pending = collections.deque()
+                for c in chunks:
+                    pending.append(pool.submit(self._post_feather, url, c))
+                    if len(pending) >= max_threads:
+                        break
+
+                while pending:
+                    table = pending.popleft().result()
+
+                    # Submit the next chunk before handing over the result
+                    c = next(chunks, None)
+                    if c is not None:
+                        pending.append(pool.submit(self._post_feather, url, c))
+
+                    pbar.update(1)
+                    yield table
+
+    def _post_feather(self, url, ids):
+        """Post query IDs and parse the Feather response into an Arrow table."""
+        resp = self.session.post(url, json={"query_ids": ids.tolist()})
+        resp.raise_for_status()
+
+        # This wraps the response content without copying it
+        return feather.read_table(pa.BufferReader(resp.content))
+
+
+def _drop_repeats(tables, chunks):
+    """Drop synapses that have already been returned for a previous chunk.
+
+    Parameters
+    ----------
+    tables :    iterable of pyarrow.Table
+                One table with "pre" and "post" columns per chunk.
+    chunks :    list of arrays
+                The query IDs for each chunk.
+
+    Yields
+    ------
+    pyarrow.Table
+
+    """
+    # Map each query ID to the (first) chunk it is in
+    # (we need matching dtypes to avoid casts to float for uint64 vs int64)
+    ids = np.concatenate(chunks).astype(np.uint64)
+    chunk_ix = np.repeat(np.arange(len(chunks)), [len(c) for c in chunks])
+    srt = np.argsort(ids, kind='stable')
+    ids, chunk_ix = ids[srt], chunk_ix[srt]
+
+    def _chunk_of(x):
+        x = x.astype(np.uint64)
+        ix = np.searchsorted(ids, x)
+        ix[ix >= len(ids)] = 0
+        return np.where(ids[ix] == x, chunk_ix[ix], len(chunks))
+
+    for i, t in enumerate(tables):
+        if t.num_rows and i > 0:
+            owner = np.minimum(_chunk_of(t.column('pre').to_numpy()),
+                               _chunk_of(t.column('post').to_numpy()))
+            t = t.filter(pa.array(owner == i))
+        yield t
 
 
 class TransformService(SpineService):
@@ -378,11 +578,18 @@ class TransformService(SpineService):
               }
 
     def __init__(self,
-                 base_url='https://spine.janelia.org/app/transform-service'):
+                 base_url='https://spine.janelia.org/app/transform-service',
+                 max_threads=4):
         """Init class."""
         self.base_url = base_url
+        self.max_threads = max_threads
         self.session = requests.Session()
 
+        # Make sure the connection pool is big enough for parallel requests
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize=max(10, max_threads))
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
     def validate_dataset(self, dataset):
         """Check if dataset exists for given service."""
         if dataset not in self.info:
@@ -456,14 +663,115 @@ class TransformService(SpineService):
             if not np.issubdtype(vxl.dtype, np.number):
                 vxl = vxl.astype(np.float64)
 
-            # Convert to voxels
+            # Convert to voxels - we go straight to float32 (which is what
+            # the service expects) to avoid intermediate copies
             vxl_size = self.info[dataset]['voxel_size']
-            vxl = np.round(vxl / vxl_size).astype(int)
+            vxl = np.divide(vxl, vxl_size, dtype=np.single)
+            np.round(vxl, out=vxl)
 
         return vxl
 
-    def get_offsets(self, x, transform, coordinates='nm', mip=-1, limit_request=10e9,
-                    on_fail='warn'):
+    def _post_chunked(self, url, vxl, dtype, width=1, limit_request=1e5,
+                      max_threads=None, max_retries=2, progress=True):
+        """Post voxel coordinates in chunks and collect binary responses.
+
+        Chunks are submitted in parallel as zero-copy slices of a single
+        float32 buffer and each response is read directly into a preallocated
+        output array. Chunks that fail are re-submitted (up to ``max_retries``
+        times) without touching chunks that already succeeded.
+
+        Parameters
+        ----------
+        url :           str
+                        URL to post to.
+        vxl :           np.ndarray (N, 3)
+                        Voxel coordinates to post.
+        dtype :         numpy dtype
+                        Data type of the response.
+        width :         int
+                        Number of values returned per point.
+        limit_request : int
+                        Max number of points per request.
+        max_threads :   int, optional
+                        Max number of parallel requests. Defaults to
+                        ``self.max_threads``.
+        max_retries :   int
+                        Max number of times a failed chunk is retried.
+        progress :      bool
+                        Whether to show a progress bar.
+
+        Returns
+        -------
+        np.ndarray
+                        (N, width) or - if ``width=1`` - (N, ) array.
+
+        """
+        if not max_threads:
+            max_threads = self.max_threads
+
+        # Preallocate the output
+        shape = (vxl.shape[0], width) if width > 1 else (vxl.shape[0], )
+        out = np.empty(shape, dtype=dtype)
+
+        limit_request = int(limit_request)
+        chunks = [(ix, min(ix + limit_request, vxl.shape[0]))
+                  for ix in range(0, vxl.shape[0], limit_request)]
+
+        # The service expects float32 - this is a no-op if `vxl` already is a
+        # contiguous float32 array. Each request then sends a slice of this
+        # one buffer without making a copy
+        payload = memoryview(np.ascontiguousarray(vxl, dtype=np.single)).cast('B')
+        row_bytes = np.dtype(np.single).itemsize * 3
+
+        def _post(start, end):
+            resp = self.session.post(url,
+                                     data=payload[start * row_bytes: end * row_bytes],
+                                     stream=True)
+            try:
+                resp.raise_for_status()
+
+                # Read the response straight into the output array
+                target = memoryview(out[start:end]).cast('B')
+                resp.raw.decode_content = True
+                n_read = 0
+                while n_read < target.nbytes:
+                    n = resp.raw.readinto(target[n_read:])
+                    if not n:
+                        break
+                    n_read += n
+            finally:
+                resp.close()
+
+            if n_read != target.nbytes:
+                raise requests.exceptions.RequestException(
+                    f'Expected {target.nbytes} bytes, got {n_read}')
+
+        with navis.config.tqdm(total=vxl.shape[0],
+                               desc='Querying',
+                               leave=False,
+                               disable=not progress or not use_pbars or len(chunks) <= 1) as pbar:
+            with futures.ThreadPoolExecutor(max_workers=max_threads) as pool:
+                pending = {pool.submit(_post, s, e): (s, e, 0) for s, e in chunks}
+                while pending:
+                    done, _ = futures.wait(pending,
+                                           return_when=futures.FIRST_COMPLETED)
+                    for f in done:
+                        start, end, tries = pending.pop(f)
+                        try:
+                            f.result()
+                        except requests.exceptions.RequestException:
+                            # Only retry this particular chunk
+                            if tries >= max_retries:
+                                raise
+                            pending[pool.submit(_post, start, end)] = (start, end, tries + 1)
+                            continue
+
+                        pbar.update(end - start)
+
+        return out
+
+    def get_offsets(self, x, transform, coordinates='nm', mip=-1, limit_request=1e5,
+                    max_threads=None, on_fail='warn', progress=True):
         """Transform coordinates.
 
         Parameters
@@ -484,8 +792,15 @@ class TransformService(SpineService):
                         resolution: -1 = highest, -2 = second highest, etc.
         coordinates :   "nm" | "voxel"
                         Units of the coordinates in ``x``.
+        limit_request : int
+                        Max number of locations to query per request.
+        max_threads :   int, optional
+                        Max number of parallel requests. Defaults to
+                        ``self.max_threads``.
         on_fail :       "warn" | "ignore" | "raise"
                         What to do if points failed to xform.
+        progress :      bool
+                        Whether to show a progress bar.
 
         Returns
         -------
@@ -508,35 +823,22 @@ class TransformService(SpineService):
         url = self.makeurl('transform/dataset', transform, 's', mip,
                            'values_binary/format/array_float_Nx3')
 
-        # Make sure we don't exceed the maximum size for each request
-        stack = []
-        limit_request = int(limit_request)
-        for ix in np.arange(0, vxl.shape[0], limit_request):
-            this_vxl = vxl[ix: ix + limit_request]
-
-            # Make request
-            resp = self.session.post(url,
-                                 data=this_vxl.astype(np.single).tobytes(order='C'))
-
-            # Check for errors
-            resp.raise_for_status()
-
-            # Extract data
-            data = np.frombuffer(resp.content, dtype=self.DTYPES[transform])
-
-            # Reshape to [[dx1, dy1], [dx2, dy2], ...]
-            data = data.reshape(this_vxl.shape[0], 2)
-            stack.append(data)
-
-        stack = np.concatenate(stack, axis=0)
+        # Returns [[dx1, dy1], [dx2, dy2], ...]
+        offsets = self._post_chunked(url, vxl,
+                                     dtype=self.DTYPES[transform],
+                                     width=2,
+                                     limit_request=limit_request,
+                                     max_threads=max_threads,
+                                     progress=progress)
 
         # See if any points failed to xform, and raise/warn if requested
-        self.validate_output(stack, on_fail=on_fail)
+        self.validate_output(offsets, on_fail=on_fail)
 
-        return stack
+        return offsets
 
     def get_segids(self, x, segmentation, coordinates='nm', mip=-1,
-                   limit_request=10e9, on_fail='warn'):
+                   limit_request=1e5, max_threads=None, on_fail='warn',
+                   progress=True):
         """Fetch segmentation/supervoxel IDs.
 
         Parameters
@@ -559,13 +861,18 @@ class TransformService(SpineService):
                         Units of the coordinates in ``x``.
         limit_request : int
                         Max number of locations to query per request.
+        max_threads :   int, optional
+                        Max number of parallel requests. Defaults to
+                        ``self.max_threads``.
         on_fail :       "warn" | "ignore" | "raise"
                         What to do if points fail to return segmentation IDs.
+        progress :      bool
+                        Whether to show a progress bar.
 
         Returns
         -------
         response :      np.ndarray
-                        (N, 2) of dx and dy offsets.
+                        (N, ) of segmentation IDs.
 
         """
         assert on_fail in ['warn', 'raise', 'ignore']
@@ -583,30 +890,17 @@ class TransformService(SpineService):
         url = self.makeurl('query/dataset', segmentation, 's', mip,
                            'values_binary/format/array_float_Nx3')
 
-        # Make sure we don't exceed the maximum size for each request
-        stack = []
-        limit_request = int(limit_request)
-        for ix in np.arange(0, vxl.shape[0], limit_request):
-            this_vxl = vxl[ix: ix + limit_request]
-
-            # Make request
-            resp = self.session.post(url,
-                                 data=this_vxl.astype(np.single).tobytes(order='C'))
-
-            # Check for errors
-            resp.raise_for_status()
-
-            # Extract data
-            data = np.frombuffer(resp.content, dtype=self.DTYPES[segmentation])
-
-            stack.append(data)
-
-        stack = np.concatenate(stack, axis=0)
+        segids = self._post_chunked(url, vxl,
+                                    dtype=self.DTYPES[segmentation],
+                                    width=1,
+                                    limit_request=limit_request,
+                                    max_threads=max_threads,
+                                    progress=progress)
 
         # See if any points failed to xform, and raise/warn if requested
-        self.validate_output(stack, on_fail=on_fail)
+        self.validate_output(segids, on_fail=on_fail)
 
-        return stack
+        return segids
 
 
 def query_spine_transform(x, dataset, query, coordinates='nm', mip=2,
@@ -16,3 +16,4 @@
 """Module containing low-level functions to work with the Buhmann FAFB synapses."""
 
 from .transmitters import plot_nt_predictions, collapse_nt_predictions
+from .local import SynapseTable
@@ -0,0 +1,192 @@
+#    A collection of tools to interface with manually traced and autosegmented
+#    data in FAFB.
+#
+#    Copyright (C) 2019 Philipp Schlegel
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+
+"""Functions to work with a local dump (Parquet/Feather) of the synapse table."""
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from pathlib import Path
+from pyarrow import feather
+
+from .transmitters import trans
+from ..spine.base import _drop_repeats
+
+__all__ = ['SynapseTable']
+
+# Columns returned by the spine synapse service
+BASE_COLUMNS = ['pre', 'post', 'cleft_scores']
+LOCATION_COLUMNS = ['pre_x', 'pre_y', 'pre_z', 'post_x', 'post_y', 'post_z']
+
+
+class SynapseTable:
+    """Local synapse table indexed by pre- and postsynaptic segment IDs.
+
+    The table is indexed via sorted ``pre`` and ``post`` arrays: look-ups
+    are ``np.searchsorted`` calls instead of scans. Note that only
+    uncompressed Feather (Arrow IPC) files are memory-mapped without a copy.
+    Parquet files (and compressed Feather files) are decoded into memory in
+    full when the table is loaded.
+    :meth:`SynapseTable.get_connectivity` mirrors
+    :meth:`fafbseg.spine.SynapseService.get_connectivity` such that the
+    table can be used as drop-in replacement for the web service.
+
+    Parameters
+    ----------
+    filepath :      str
+                    Path to a Feather or Parquet (``.parquet``, ``.pq``) file
+                    with (at least) ``pre``, ``post`` and ``cleft_scores``
+                    columns. Locations (``pre_x``, ``pre_y``, ...) and
+                    neurotransmitter predictions (``gaba``,
+                    ``acetylcholine``, ...) are optional.
+
+    """
+
+    def __init__(self, filepath):
+        """Initialize."""
+        self.filepath = Path(filepath).expanduser()
+
+        if not self.filepath.is_file():
+            raise ValueError(f'Synapse table "{self.filepath}" does not exist')
+
+        if self.filepath.suffix in ('.parquet', '.pq'):
+            self.table = pq.read_table(self.filepath, memory_map=True)
+        else:
+            self.table = feather.read_table(self.filepath, memory_map=True)
+
+        missing = set(BASE_COLUMNS) - set(self.table.column_names)
+        if missing:
+            raise ValueError(f'Synapse table is missing column(s): {missing}')
+
+        self._index = {}
+
+    def __len__(self):
+        return self.table.num_rows
+
+    def __repr__(self):
+        return f'<SynapseTable rows={len(self)} file="{self.filepath}">'
+
+    def get_index(self, col):
+        """Return (sorted values, row indices) for ``pre`` or ``post``."""
+        if col not in self._index:
+            values = self.table.column(col).to_numpy().astype(np.int64, copy=False)
+            order = np.argsort(values, kind='stable')
+            self._index[col] = (values[order], order)
+        return self._index[col]
+
+    def get_rows(self, ids, pre=True, post=True):
+        """Find (sorted, unique) rows for given segment IDs."""
+        ids = np.unique(np.asarray(ids, dtype=np.int64))
+
+        rows = []
+        for col, use in zip(('pre', 'post'), (pre, post)):
+            if not use:
+                continue
+            values, order = self.get_index(col)
+            left = np.searchsorted(values, ids, side='left')
+            right = np.searchsorted(values, ids, side='right')
+            rows.append(order[_ranges(left, right)])
+
+        if not rows:
+            return np.zeros(0, dtype=np.int64)
+
+        return np.unique(np.concatenate(rows))
+
+    def get_connectivity(self, segmentation_ids, segmentation=None,
+                         locations=False, nt_predictions=False,
+                         chunksize=50000, iterator=False, as_arrow=False,
+                         **kwargs):
+        """Fetch all connections from/to given segmentation ID(s).
+
+        Parameters
+        ----------
+        segmentation_ids :  int | list of int
+                            Segmentation IDs to fetch synapses for.
+        segmentation :      str
+                            Ignored - exists only for compatibility with the
+                            web service.
+        locations :         bool
+                            If True, will also return locations.
+        nt_predictions :    bool
+                            If True, will also return neurotransmitter
+                            predictions.
+        chunksize :         int
+                            Number of segmentation IDs per table if
+                            ``iterator=True`` - same as for the web service.
+        iterator :          bool
+                            If True, will return a generator of tables.
+        as_arrow :          bool
+                            If True, will return ``pyarrow.Table`` instead of
+                            ``pandas.DataFrame``.
+        **kwargs
+                            Ignored.
+
+        Returns
+        -------
+        pandas.DataFrame | pyarrow.Table
+                            If ``iterator=False``.
+        generator
+                            If ``iterator=True``.
+
+        """
+        columns = list(BASE_COLUMNS)
+        if locations:
+            columns += LOCATION_COLUMNS
+        if nt_predictions:
+            columns += trans
+
+        missing = set(columns) - set(self.table.column_names)
+        if missing:
+            raise ValueError(f'Synapse table is missing column(s): {missing}')
+
+        segmentation_ids = np.atleast_1d(segmentation_ids)
+        table = self.table.select(columns)
+
+        if iterator:
+            # Chunk by segmentation IDs (not synapses) just like the service
+            chunksize = max(int(chunksize), 1)
+            chunks = [segmentation_ids[i: i + chunksize]
+                      for i in range(0, max(len(segmentation_ids), 1), chunksize)]
+            tables = (table.take(pa.array(self.get_rows(c))) for c in chunks)
+
+            # A synapse between IDs in different chunks is found for each
+            # of these chunks -> only keep it for the first one
+            if len(chunks) > 1:
+                tables = _drop_repeats(tables, chunks)
+
+            if as_arrow:
+                return tables
+            return (t.to_pandas() for t in tables)
+
+        table = table.take(pa.array(self.get_rows(segmentation_ids)))
+
+        if as_arrow:
+            return table
+
+        return table.to_pandas()
+
+
+def _ranges(starts, stops):
+    """Concatenate ``np.arange(start, stop)`` for all start/stop pairs."""
+    lens = stops - starts
+    lens[lens < 0] = 0
+    if not lens.sum():
+        return np.zeros(0, dtype=np.int64)
+
+    # Offsets of each range in the output
+    offsets = np.repeat(starts - np.cumsum(lens) + lens, lens)
+
+    return np.arange(lens.sum()) + offsets
@@ -15,54 +15,251 @@
 
 """Functions to work with synapse data from a local SQL data base."""
 
+import itertools
 import navis
 import os
 import sqlite3
+import threading
 
-import networkx as nx
 import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
 
-from scipy.spatial import cKDTree
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
 from tqdm.auto import tqdm
 
-from .utils import assign_connectors
+from .parquet import ParquetStore
+from .utils import (assign_connectors, closest_nodes, get_kdtree,
+                    drop_duplicate_synapses)
 from .. import google
+from ..utils import top_owners
 
-conn = None
+# Path to the database and per-thread connections
+DB_PATH = None
+_local = threading.local()
+
+# Databases for which we have verified indices
+_INDEXED = set()
+_index_lock = threading.Lock()
+
+# Parquet stores: {path: ParquetStore}
+_PARQUET_STORES = {}
+
+# Counter for unique names of temporary tables
+_TABLE_COUNTER = itertools.count()
+
+# Thread pool for queries - its threads (and their connections) are re-used
+_EXECUTOR = None
+_EXECUTOR_THREADS = None
+_executor_lock = threading.Lock()
+
+# Connection settings in bytes
+MMAP_SIZE = 2 ** 30
+CACHE_SIZE = 2 ** 28
 
 
 __all__ = ['query_synapses', 'query_connections', 'get_neuron_synapses',
-           'get_neuron_connections']
+           'get_neuron_connections', 'sqlite_to_parquet']
+
+# Data types for the synapse table
+# A lot of these come out at 64 bit but with the exception of
+# segmentation IDs 32 bit is more than enough
+DTYPES = {'pre_x': np.int32,
+          'pre_y': np.int32,
+          'pre_z': np.int32,
+          'post_x': np.int32,
+          'post_y': np.int32,
+          'post_z': np.int32,
+          'cleft_scores': np.int32,
+          'dist': np.float32,
+          'segmentid_post': np.int64,
+          'segmentid_pre': np.int64,
+          'scores': np.float32,
+          'clust_con_offset': np.int32,
+          'cleft_id': np.int32,
+          'prob_count': np.int32,
+          'prob_max': np.int32,
+          'prob_mean': np.int32,
+          'prob_min': np.int32,
+          'prob_sum': np.int32,
+          'offset': np.int32
+          }
 
 
 def get_connection(filepath=None, force_reconnect=False):
-    """Connect to SQL DB containg the synapses."""
-    global conn
+    """Connect to SQL DB containg the synapses.
+
+    Connections are per thread (SQLite connections must not be shared across
+    threads) and read-only. Each thread gets its own connection to the same
+    database on first use.
+
+    If ``filepath`` points to a directory or a ``.parquet`` file, will
+    return a :class:`~fafbseg.synapses.parquet.ParquetStore` instead.
+
+    """
+    global DB_PATH
 
-    # This prevents us from intializing many connections
-    if conn and not force_reconnect:
-        if filepath:
+    # This prevents us from switching databases by accident
+    if DB_PATH and filepath and not force_reconnect:
+        if os.path.abspath(filepath) != DB_PATH:
             print('A connection to a database already exists. Call '
                   'get_connection() with `force_reconnect=True` to '
                   'force re-initialization.')
-        return conn
+    elif filepath:
+        DB_PATH = os.path.abspath(filepath)
 
-    if not filepath:
+    if not DB_PATH:
         filepath = os.environ.get('BUHMANN_SYNAPSE_DB', None)
 
-    if not filepath:
-        raise ValueError('Must provided filepath to SQL synapse database '
-                         'either as `filepath` parameter or as '
-                         '`BUHMANN_SYNAPSE_DB` environment variable.')
+        if not filepath:
+            raise ValueError('Must provided filepath to SQL synapse database '
+                             'either as `filepath` parameter or as '
+                             '`BUHMANN_SYNAPSE_DB` environment variable.')
+
+        DB_PATH = os.path.abspath(filepath)
+
+    # Parquet datasets (see `sqlite_to_parquet`) are queried via pyarrow
+    if _is_parquet(DB_PATH):
+        if DB_PATH not in _PARQUET_STORES or force_reconnect:
+            _PARQUET_STORES[DB_PATH] = ParquetStore(DB_PATH)
+        return _PARQUET_STORES[DB_PATH]
+
+    if not os.path.isfile(DB_PATH):
+        raise ValueError(f'SQL synapse database "{DB_PATH}" does not exist')
+
+    conn = getattr(_local, 'conn', None)
+    if conn and getattr(_local, 'path', None) == DB_PATH and not force_reconnect:
+        return conn
+
+    # Close this thread's outdated connection before replacing it
+    if conn:
+        conn.close()
+        _local.conn = None
+
+    # Make sure we can look up synapses by segment ID without full scans
+    # (this needs a writable connection and happens only once per database)
+    with _index_lock:
+        if DB_PATH not in _INDEXED:
+            with sqlite3.connect(DB_PATH) as rw:
+                _ensure_indices(rw)
+            rw.close()
+            _INDEXED.add(DB_PATH)
 
-    conn = sqlite3.connect(filepath)
+    _local.conn = _connect_read_only(DB_PATH)
+    _local.path = DB_PATH
+
+    return _local.conn
+
+
+def _get_executor(max_threads):
+    """Return module-level thread pool with ``max_threads`` workers.
+
+    Re-using the pool means each worker keeps its read-only connection (and
+    its page cache) across queries.
+
+    """
+    global _EXECUTOR, _EXECUTOR_THREADS
+
+    with _executor_lock:
+        if _EXECUTOR is None or _EXECUTOR_THREADS != max_threads:
+            if _EXECUTOR is not None:
+                # Workers' connections are closed when their threads exit
+                _EXECUTOR.shutdown(wait=True)
+            _EXECUTOR = ThreadPoolExecutor(max_workers=max_threads,
+                                           thread_name_prefix='synapse_db')
+            _EXECUTOR_THREADS = max_threads
+        return _EXECUTOR
+
+
+def _is_parquet(filepath):
+    """Check if filepath points to a Parquet store."""
+    return os.path.isdir(filepath) or filepath.endswith(('.parquet', '.pq'))
+
+
+def _connect_read_only(filepath):
+    """Open read-only connection tuned for lookups."""
+    uri = f'{Path(filepath).as_uri()}?mode=ro'
+    conn = sqlite3.connect(uri, uri=True)
+
+    # Memory-map the database and give each connection a decent page cache
+    conn.execute(f'PRAGMA mmap_size={MMAP_SIZE};')
+    conn.execute(f'PRAGMA cache_size=-{CACHE_SIZE // 1024};')
 
     return conn
 
 
+def _ensure_indices(conn):
+    """Verify (and if necessary create) indices on segment ID columns."""
+    # Find columns that are the leading column of an existing index
+    indexed = set()
+    for idx in conn.execute('PRAGMA index_list(synlinks);').fetchall():
+        info = conn.execute(f'PRAGMA index_info("{idx[1]}");').fetchall()
+        if info:
+            indexed.add(sorted(info)[0][2])
+
+    for col in ('segmentid_pre', 'segmentid_post'):
+        if col in indexed:
+            continue
+        print(f'Creating index for "{col}" - this is a one-off but might '
+              'take a while.')
+        try:
+            conn.execute(f'CREATE INDEX IF NOT EXISTS idx_synlinks_{col} '
+                         f'ON synlinks ({col});')
+            conn.commit()
+        except sqlite3.OperationalError as e:
+            print(f'Unable to create index for "{col}" (queries will be '
+                  f'slow): {e}')
+
+
+def _load_ids(conn, prefix, ids):
+    """Load IDs into a new temporary table to join against.
+
+    Each query gets its own uniquely named table, such that (lazily consumed)
+    queries on the same connection can't interfere with each other.
+
+    Returns
+    -------
+    str
+                Name of the temporary table.
+
+    """
+    # Clean up tables we previously failed to drop
+    _drop_tables(conn, [])
+
+    table = f'{prefix}_{next(_TABLE_COUNTER)}'
+    conn.execute(f'CREATE TEMP TABLE {table} (id INTEGER PRIMARY KEY);')
+    conn.executemany(f'INSERT OR IGNORE INTO temp.{table} (id) VALUES (?);',
+                     ((int(i), ) for i in ids))
+    return table
+
+
+def _drop_tables(conn, tables):
+    """Drop temporary tables.
+
+    SQLite refuses to drop tables while other statements on the same
+    connection are still pending (e.g. a half-consumed iterator). Such
+    tables are dropped on a later call.
+
+    """
+    pending = getattr(_local, 'stale_tables', {})
+    stale = pending.get(id(conn), []) + list(tables)
+
+    remaining = []
+    for t in stale:
+        try:
+            conn.execute(f'DROP TABLE IF EXISTS temp.{t};')
+        except sqlite3.OperationalError:
+            remaining.append(t)
+
+    pending[id(conn)] = remaining
+    _local.stale_tables = pending
+
+
 def query_synapses(seg_ids, pre=True, post=True, score_thresh=30, ret='brief',
-                   downcast=True, db=None):
+                   downcast=True, iterator=False, chunksize=100000,
+                   max_threads=4, db=None):
     """Fetch synapses for given segment IDs.
 
     Parameters
@@ -81,6 +278,15 @@ def query_synapses(seg_ids, pre=True, post=True, score_thresh=30, ret='brief',
     downcast:       bool
                     If True, will downcast some columns to a more reasonable
                     (and compact) datatype (usually int/float64 -> int/float32).
+    iterator :      bool
+                    If True, will return a generator of DataFrames with
+                    ``chunksize`` rows each. Use this for very large results.
+    chunksize :     int
+                    Number of rows to read at a time.
+    max_threads :   int
+                    Number of threads to split the query across. Each thread
+                    uses its own read-only connection. Ignored if
+                    ``iterator=True``.
     db :            str, optional
                     Must point to SQL database containing the synapse data. If
                     not provided will look for a `BUHMANN_SYNAPSE_DB`
@@ -89,78 +295,226 @@ def query_synapses(seg_ids, pre=True, post=True, score_thresh=30, ret='brief',
     Return
     ------
     pd.DataFrame
+                    If ``iterator=False``.
+    generator
+                    If ``iterator=True``.
 
     """
     assert ret in ('brief', 'full')
     assert isinstance(score_thresh, (type(None), int, float))
 
+    if not pre and not post:
+        raise ValueError('`pre` and `post` must not both be False')
+
+    # Make sure we have a database
     conn = get_connection(db)
 
     seg_ids = navis.utils.make_iterable(seg_ids)
 
-    # Turn into query string
-    seg_ids_str = f'{",".join(seg_ids.astype(str))}'
-
     # Create query
     if ret == 'brief':
         cols = ['pre_x', 'pre_y', 'pre_z', 'post_x', 'post_y', 'post_z', 'scores',
                 'cleft_id', 'cleft_scores', 'segmentid_post', 'segmentid_pre']
     else:
         cols = ['*']
-    sel = f'SELECT {", ".join(cols)} from synlinks'
+
+    if isinstance(conn, ParquetStore):
+        return conn.query(pre_ids=seg_ids if pre else None,
+                          post_ids=seg_ids if post else None,
+                          how='or',
+                          columns=cols if ret == 'brief' else None,
+                          score_thresh=score_thresh,
+                          dtypes=_get_dtypes(downcast),
+                          iterator=iterator,
+                          chunksize=chunksize)
+
+    kwargs = dict(all_ids=seg_ids, pre=pre, post=post, cols=cols,
+                  score_thresh=score_thresh, downcast=downcast)
+
+    if iterator or max_threads <= 1 or len(seg_ids) < 2 * max_threads:
+        return _query_synapses(seg_ids, iterator=iterator,
+                               chunksize=chunksize, **kwargs)
+
+    # Split IDs and run queries in parallel - each thread uses its own
+    # (persistent) connection
+    executor = _get_executor(max_threads)
+    futures = [executor.submit(_query_synapses, ids, **kwargs)
+               for ids in np.array_split(seg_ids, max_threads)]
+    return pd.concat([f.result() for f in futures],
+                     axis=0, ignore_index=True)
+
+
+def _query_synapses(seg_ids, all_ids, pre, post, cols, score_thresh=None,
+                    downcast=True, iterator=False, chunksize=100000):
+    """Query synapses for (a chunk of) segment IDs.
+
+    ``all_ids`` are the full set of query IDs: synapses where both pre- and
+    postsynaptic segment are query IDs are only returned for the presynaptic
+    segment - i.e. combining results from chunks won't produce duplicates.
+
+    """
+    conn = get_connection()
+
+    # Load IDs into temporary table(s)
+    ids_table = _load_ids(conn, '_query_ids', seg_ids)
+    tables = [ids_table]
+    if len(seg_ids) == len(all_ids):
+        all_table = ids_table
+    else:
+        all_table = _load_ids(conn, '_query_all_ids', all_ids)
+        tables.append(all_table)
+
+    # Note: CROSS JOIN forces SQLite to loop over our (few) IDs and use the
+    # index on synlinks instead of scanning the full table
+    sel = (f'SELECT {", ".join([f"s.{c}" for c in cols])} '
+           f'FROM temp.{ids_table} q CROSS JOIN synlinks s')
+
+    if score_thresh:
+        score = 'AND s.cleft_scores >= ?'
+        params = [score_thresh]
+    else:
+        score, params = '', []
+
+    pre_query = f'{sel} ON s.segmentid_pre = q.id WHERE 1 {score}'
+    post_query = f'{sel} ON s.segmentid_post = q.id WHERE 1 {score}'
 
     if pre and post:
-        where = f'WHERE (segmentid_pre IN ({seg_ids_str}) OR segmentid_post in ({seg_ids_str}))'
+        # Avoid returning synapses twice
+        query = (f'{pre_query} UNION ALL {post_query} AND s.segmentid_pre '
+                 f'NOT IN (SELECT id FROM temp.{all_table})')
+        params = params * 2
     elif pre:
-        where = f'WHERE segmentid_pre IN ({seg_ids_str})'
-    elif post:
-        where = f'WHERE segmentid_post IN ({seg_ids_str})'
+        query = pre_query
     else:
-        raise ValueError('`pre` and `post` must not both be False')
+        query = post_query
 
-    if score_thresh:
-        where += f' AND cleft_scores >= {score_thresh}'
-
-    return _query_database(f'{sel} {where};', conn, downcast=downcast)
-
-
-def _query_database(query, conn, downcast=True):
-    """Query the synapse database."""
-    resp = pd.read_sql(query, conn)
-
-    # Fix some data types
-    # A lot of these come out at 64 bit but with the exception of
-    # segmentation IDs 32 bit is more than enough
-    DTYPES = {'pre_x': np.int32,
-              'pre_y': np.int32,
-              'pre_z': np.int32,
-              'post_x': np.int32,
-              'post_y': np.int32,
-              'post_z': np.int32,
-              'cleft_scores': np.int32,
-              'dist': np.float32,
-              'segmentid_post': np.int64,
-              'segmentid_pre': np.int64,
-              'scores': np.float32,
-              'clust_con_offset': np.int32,
-              'cleft_id': np.int32,
-              'prob_count': np.int32,
-              'prob_max': np.int32,
-              'prob_mean': np.int32,
-              'prob_min': np.int32,
-              'prob_sum': np.int32,
-              'offset': np.int32
-              }
+    return _query_database(f'{query};', conn, params=params, downcast=downcast,
+                           iterator=iterator, chunksize=chunksize,
+                           temp_tables=tables)
 
-    if downcast:
-        to_conv = {k: v for k, v in DTYPES.items() if k in resp.columns}
-        resp = resp.astype(to_conv, errors='ignore')
 
-    return resp
+def _query_database(query, conn, params=None, downcast=True, iterator=False,
+                    chunksize=100000, temp_tables=None):
+    """Query the synapse database.
+
+    Rows are fetched in chunks and turned into typed arrays (see ``DTYPES``)
+    which are concatenated once at the end. The number of rows is not known
+    up front (counting would mean running the query twice), so peak memory
+    is not bounded by the final arrays alone: chunks are concatenated and
+    released one column at a time, i.e. the peak is roughly the final
+    (downcast) size plus that of the largest column. ``temp_tables`` are
+    dropped once all rows have been read.
+
+    """
+    params = params or []
+
+    if iterator:
+        return _iter_query(query, conn, params=params, downcast=downcast,
+                           chunksize=chunksize, temp_tables=temp_tables)
+
+    try:
+        cur = conn.execute(query, params)
+        cols = [d[0] for d in cur.description]
+
+        chunks = {c: [] for c in cols}
+        while True:
+            rows = cur.fetchmany(chunksize)
+            if not rows:
+                break
+
+            for c, values in _rows_to_arrays(rows, cols, downcast).items():
+                chunks[c].append(values)
+    finally:
+        _drop_tables(conn, temp_tables or [])
+
+    data = {}
+    for c in cols:
+        # Pop chunks such that they can be freed as soon as they are merged
+        values = chunks.pop(c)
+        if values:
+            data[c] = np.concatenate(values)
+        else:
+            data[c] = np.zeros(0, dtype=_get_dtype(c, downcast) or np.float64)
+        del values
+
+    return pd.DataFrame(data, columns=cols)
+
+
+def _iter_query(query, conn, params=None, downcast=True, chunksize=100000,
+                temp_tables=None):
+    """Iterate over query results in chunks of DataFrames.
+
+    The query is executed right away (not on first iteration) - i.e. the
+    results reflect the state at the time of calling.
+
+    """
+    try:
+        cur = conn.execute(query, params or [])
+    except BaseException:
+        _drop_tables(conn, temp_tables or [])
+        raise
+
+    return _iter_cursor(cur, conn, downcast=downcast, chunksize=chunksize,
+                        temp_tables=temp_tables)
+
+
+def _iter_cursor(cur, conn, downcast=True, chunksize=100000, temp_tables=None):
+    """Yield DataFrames from an executed cursor."""
+    cols = [d[0] for d in cur.description]
+    try:
+        while True:
+            rows = cur.fetchmany(chunksize)
+            if not rows:
+                break
+            yield pd.DataFrame(_rows_to_arrays(rows, cols, downcast),
+                               columns=cols)
+    finally:
+        cur.close()
+        _drop_tables(conn, temp_tables or [])
+
+
+def _rows_to_arrays(rows, cols, downcast=True):
+    """Turn list of row tuples into typed arrays for each column.
+
+    Values are written straight into the typed arrays (``np.fromiter``)
+    without building intermediate lists of Python objects.
+
+    """
+    data = {}
+    for k, c in enumerate(cols):
+        dtype = _get_dtype(c, downcast)
+        if dtype is None:
+            data[c] = np.array([r[k] for r in rows])
+            continue
+        try:
+            data[c] = np.fromiter((r[k] for r in rows), dtype=dtype,
+                                  count=len(rows))
+        except (TypeError, ValueError):
+            # This happens if integer columns contain NULLs
+            data[c] = np.fromiter((np.nan if r[k] is None else r[k] for r in rows),
+                                  dtype=np.float64, count=len(rows))
+    return data
+
+
+def _get_dtypes(downcast=True):
+    """Get data types for all known columns."""
+    return {c: _get_dtype(c, downcast) for c in DTYPES}
+
+
+def _get_dtype(col, downcast=True):
+    """Get data type for given column (None if unknown)."""
+    if col not in DTYPES:
+        return None
+    if downcast:
+        return DTYPES[col]
+    if np.issubdtype(DTYPES[col], np.integer):
+        return np.int64
+    return np.float64
 
 
 def query_connections(pre_ids, post_ids, score_thresh=30, ret='brief',
-                      downcast=True, db=None):
+                      downcast=True, iterator=False, chunksize=100000,
+                      db=None):
     """Fetch synaptic connections between given segment IDs.
 
     Parameters
@@ -177,6 +531,11 @@ def query_connections(pre_ids, post_ids, score_thresh=30, ret='brief',
     downcast:       bool
                     If True, will downcast some columns to a more reasonable
                     (and compact) datatype (usually int/float64 -> int/float32).
+    iterator :      bool
+                    If True, will return a generator of DataFrames with
+                    ``chunksize`` rows each. Use this for very large results.
+    chunksize :     int
+                    Number of rows to read at a time.
     db :            str, optional
                     Must point to SQL database containing the synapse data. If
                     not provided will look for a `BUHMANN_SYNAPSE_DB`
@@ -185,6 +544,9 @@ def query_connections(pre_ids, post_ids, score_thresh=30, ret='brief',
     Return
     ------
     pd.DataFrame
+                    If ``iterator=False``.
+    generator
+                    If ``iterator=True``.
 
     """
     assert ret in ('brief', 'full')
@@ -193,11 +555,24 @@ def query_connections(pre_ids, post_ids, score_thresh=30, ret='brief',
     conn = get_connection(db)
 
     pre_ids = navis.utils.make_iterable(pre_ids)
-    post_ids = navis.utils.make_iterable(pre_ids)
-
-    # Turn into query string
-    pre_ids_str = f'{",".join(pre_ids.astype(str))}'
-    post_ids_str = f'{",".join(post_ids.astype(str))}'
+    post_ids = navis.utils.make_iterable(post_ids)
+
+    if isinstance(conn, ParquetStore):
+        return conn.query(pre_ids=pre_ids,
+                          post_ids=post_ids,
+                          how='and',
+                          columns=None if ret == 'full' else [
+                              'pre_x', 'pre_y', 'pre_z', 'post_x', 'post_y',
+                              'post_z', 'scores', 'cleft_id', 'cleft_scores',
+                              'segmentid_post', 'segmentid_pre'],
+                          score_thresh=score_thresh,
+                          dtypes=_get_dtypes(downcast),
+                          iterator=iterator,
+                          chunksize=chunksize)
+
+    # Load IDs into temporary tables
+    pre_table = _load_ids(conn, '_query_pre_ids', pre_ids)
+    post_table = _load_ids(conn, '_query_post_ids', post_ids)
 
     # Create query
     if ret == 'brief':
@@ -205,20 +580,100 @@ def query_connections(pre_ids, post_ids, score_thresh=30, ret='brief',
                 'cleft_id', 'cleft_scores', 'segmentid_post', 'segmentid_pre']
     else:
         cols = ['*']
-    sel = f'SELECT {", ".join(cols)} from synlinks'
+    sel = f'SELECT {", ".join([f"s.{c}" for c in cols])}'
 
-    where = f'WHERE (segmentid_pre IN ({pre_ids_str}) AND segmentid_post in ({post_ids_str}))'
+    # Note: CROSS JOIN forces SQLite to loop over our (few) IDs and use the
+    # index on synlinks instead of scanning the full table
+    query = (f'{sel} FROM temp.{pre_table} pre '
+             'CROSS JOIN synlinks s ON s.segmentid_pre = pre.id '
+             f'JOIN temp.{post_table} post ON s.segmentid_post = post.id')
 
+    params = []
     if score_thresh:
-        where += f' AND cleft_scores >= {score_thresh}'
+        query += ' WHERE s.cleft_scores >= ?'
+        params.append(score_thresh)
+
+    return _query_database(f'{query};', conn=conn, params=params,
+                           downcast=downcast, iterator=iterator,
+                           chunksize=chunksize,
+                           temp_tables=[pre_table, post_table])
+
+
+def sqlite_to_parquet(db, outdir, sort_by='segmentid_pre',
+                      rows_per_file=5e7, row_group_size=1e6, progress=True):
+    """Convert SQLite synapse database to a Parquet dataset.
+
+    The synapses are written sorted by ``sort_by`` such that every row group
+    covers only a small range of segment IDs - this lets queries skip row
+    groups based on their statistics. Once converted, point
+    ``BUHMANN_SYNAPSE_DB`` (or the ``db`` parameter of the query functions)
+    to ``outdir`` to use it.
+
+    Parameters
+    ----------
+    db :            str
+                    Path to the SQLite database.
+    outdir :        str
+                    Directory to write Parquet files to.
+    sort_by :       str
+                    Column to sort by. Queries filtering on this column
+                    benefit the most.
+    rows_per_file : int
+                    Max number of rows per Parquet file.
+    row_group_size : int
+                    Number of rows per row group.
+    progress :      bool
+                    Whether to show a progress bar.
+
+    Returns
+    -------
+    None
 
-    return _query_database(f'{sel} {where};', conn=conn, downcast=downcast)
+    """
+    if sort_by not in ('segmentid_pre', 'segmentid_post'):
+        raise ValueError('`sort_by` must be "segmentid_pre" or "segmentid_post"')
+
+    db = os.path.abspath(os.path.expanduser(db))
+    outdir = Path(outdir).expanduser()
+    outdir.mkdir(parents=True, exist_ok=True)
+
+    conn = _connect_read_only(db)
+    n_rows = conn.execute('SELECT COUNT(*) FROM synlinks;').fetchone()[0]
+
+    chunks = _iter_query(f'SELECT * FROM synlinks ORDER BY {sort_by};', conn,
+                         downcast=True, chunksize=int(row_group_size))
+
+    rows_per_file = int(rows_per_file)
+    writer, n_file, i = None, 0, 0
+    with tqdm(total=n_rows, desc='Converting', disable=not progress,
+              leave=False) as pbar:
+        for df in chunks:
+            table = pa.Table.from_pandas(df, preserve_index=False)
+
+            if writer is None or n_file >= rows_per_file:
+                if writer is not None:
+                    writer.close()
+                writer = pq.ParquetWriter(outdir / f'part-{i:05d}.parquet',
+                                          table.schema)
+                n_file, i = 0, i + 1
+            elif table.schema != writer.schema:
+                table = table.cast(writer.schema)
+
+            writer.write_table(table, row_group_size=int(row_group_size))
+            n_file += table.num_rows
+            pbar.update(table.num_rows)
+
+    if writer is not None:
+        writer.close()
+
+    conn.close()
 
 
 def get_neuron_synapses(x, pre=True, post=True, collapse_connectors=False,
                         score_thresh=30, ol_thresh=2, dist_thresh=1000,
                         attach=True, drop_autapses=True, drop_duplicates=True,
-                        db=None, verbose=True, ret='catmaid', progress=True):
+                        db=None, verbose=True, ret='catmaid', max_threads=4,
+                        progress=True):
     """Fetch synapses for a given neuron.
 
     Works by:
@@ -279,6 +734,9 @@ def get_neuron_synapses(x, pre=True, post=True, collapse_connectors=False,
                     If "full" will return all synapse properties. If "brief"
                     will return more relevant subset. If "catmaid" will return
                     only CATMAID-like columns.
+    max_threads :   int
+                    Number of threads to use for querying the database and
+                    for building KD-trees.
     progress :      bool
                     Whether to show progress bars or not.
 
@@ -298,25 +756,23 @@ def get_neuron_synapses(x, pre=True, post=True, collapse_connectors=False,
     if not isinstance(x, navis.NeuronList):
         x = navis.NeuronList([x])
 
-    # Get segments for this neuron(s)
-    seg_ids = google.neuron_to_segments(x)
+    # Get segments for this neuron(s) as sparse (neuron, segment, counts)
+    overlap = google.neuron_to_segments(x, sparse=True)
+
+    # We will make sure that every segment ID is only attributed to a single
+    # neuron (or several in case of ties)
+    overlap = top_owners(overlap, id_col='skeleton_id', seg_col='seg_id')
 
     # Drop segments with overlap below threshold
     if ol_thresh:
-        seg_ids = seg_ids.loc[seg_ids.max(axis=1) >= ol_thresh]
-
-    # We will make sure that every segment ID is only attributed to a single
-    # neuron
-    not_top = seg_ids.values != seg_ids.max(axis=1).values.reshape((seg_ids.shape[0], 1))
-    where_not_top = np.where(not_top)
-    if np.any(where_not_top[0]):
-        seg_ids.values[where_not_top] = None  # do not change this to 0
+        overlap = overlap[overlap.counts >= ol_thresh]
 
     # Fetch pre- and postsynapses associated with these segments
     # It's cheaper to get them all in one go
-    syn = query_synapses(seg_ids.index.values,
+    syn = query_synapses(overlap.seg_id.unique(),
                          score_thresh=score_thresh,
                          ret=ret if ret != 'catmaid' else 'brief',
+                         max_threads=max_threads,
                          db=None)
 
     # Drop autapses - they are most likely wrong
@@ -324,42 +780,8 @@ def get_neuron_synapses(x, pre=True, post=True, collapse_connectors=False,
         syn = syn[syn.segmentid_pre != syn.segmentid_post]
 
     if drop_duplicates:
-        dupl_thresh = 250
-        # Deal with pre- and postsynapses separately
-        while True:
-            # Generate pairs of pre- and postsynaptic coordinates that are
-            # suspiciously close
-            pre_tree = cKDTree(syn[['pre_x', 'pre_y', 'pre_z']].values)
-            post_tree = cKDTree(syn[['post_x', 'post_y', 'post_z']].values)
-            pre_pairs = pre_tree.query_pairs(r=dupl_thresh)
-            post_pairs = post_tree.query_pairs(r=dupl_thresh)
-
-            # We will consider pairs for removal where both pre- OR postsynapse
-            # are close - this is easy to change via below operator
-            pairs = pre_pairs | post_pairs  # union of both
-            pairs = np.array(list(pairs))
-
-            # For each pair check if they connect the same IDs
-            same_pre = syn.iloc[pairs[:, 0]].segmentid_pre.values == syn.iloc[pairs[:, 1]].segmentid_pre.values
-            same_post = syn.iloc[pairs[:, 0]].segmentid_post.values == syn.iloc[pairs[:, 1]].segmentid_post.values
-            same_cn = same_pre & same_post
-
-            # If no more pairs to collapse break
-            if same_cn.sum() == 0:
-                break
-
-            # Generate a graph from pairs
-            G = nx.Graph()
-            G.add_edges_from(pairs[same_cn])
-
-            # Find the minimum number of nodes we need to remove
-            # to separate the connectors
-            to_rm = []
-            for cn in nx.connected_components(G):
-                to_rm += list(nx.minimum_node_cut(nx.subgraph(G, cn)))
-
-            # Drop those nodes
-            syn = syn.drop(index=syn.index.values[to_rm])
+        # Merge synapses connecting the same segments within 250nm
+        syn = syn[drop_duplicate_synapses(syn, dist=250)]
         # Reset index
         syn.reset_index(drop=True, inplace=True)
 
@@ -369,13 +791,20 @@ def get_neuron_synapses(x, pre=True, post=True, collapse_connectors=False,
         # Make fake IDs
         syn['connector_id'] = np.arange(syn.shape[0]).astype(np.int32)
 
+    # Build KD-trees for all neurons in parallel - they are cached
+    # and re-used when mapping connectors to nodes below
+    with ThreadPoolExecutor(max_workers=max_threads) as executor:
+        _ = list(executor.map(get_kdtree, [x.idx[c] for c in overlap.skeleton_id.unique()]))
+
     # Now associate synapses with neurons
     tables = []
-    for c in tqdm(seg_ids.columns,
-                  desc='Proc. neurons',
-                  disable=not progress or seg_ids.shape[1] == 1,
-                  leave=False):
-        this_segs = seg_ids.loc[seg_ids[c].notnull(), c]
+    by_neuron = overlap.groupby('skeleton_id')
+    for c, this in tqdm(by_neuron,
+                        desc='Proc. neurons',
+                        total=by_neuron.ngroups,
+                        disable=not progress or by_neuron.ngroups == 1,
+                        leave=False):
+        this_segs = pd.Series(this.counts.values, index=this.seg_id.values)
         is_pre = syn.segmentid_pre.isin(this_segs.index.values)
         is_post = syn.segmentid_post.isin(this_segs.index.values)
 
@@ -389,8 +818,8 @@ def get_neuron_synapses(x, pre=True, post=True, collapse_connectors=False,
         if any(is_dupl):
             dupl = syn[is_dupl]
             # Next get the overlap counts for the pre- and postsynaptic seg IDs
-            dupl_pre_ol = seg_ids.loc[dupl.segmentid_pre, c].values
-            dupl_post_ol = seg_ids.loc[dupl.segmentid_post, c].values
+            dupl_pre_ol = this_segs.loc[dupl.segmentid_pre].values
+            dupl_post_ol = this_segs.loc[dupl.segmentid_post].values
 
             # We go for the one with more overlap
             true_pre = dupl_pre_ol > dupl_post_ol
@@ -428,9 +857,10 @@ def get_neuron_synapses(x, pre=True, post=True, collapse_connectors=False,
         # Map connectors to nodes
         # Note that this is where we enforce `dist_thresh`
         neuron = x.idx[c]
-        tree = navis.neuron2KDTree(neuron)
+        tree = get_kdtree(neuron)
         dist, ix = tree.query(connectors[['x', 'y', 'z']].values,
-                              distance_upper_bound=dist_thresh)
+                              distance_upper_bound=dist_thresh,
+                              workers=-1)
 
         # Drop far away connectors
         connectors = connectors.loc[dist < np.inf]
@@ -466,7 +896,7 @@ def get_neuron_synapses(x, pre=True, post=True, collapse_connectors=False,
 def get_neuron_connections(sources, targets=None, agglomerate=True,
                            score_thresh=30, ol_thresh=5, dist_thresh=2000,
                            drop_duplicates=True, drop_autapses=True, db=None,
-                           verbose=True):
+                           max_threads=4, verbose=True):
     """Fetch connections between sets of neurons.
 
     Works by:
@@ -506,6 +936,8 @@ def get_neuron_connections(sources, targets=None, agglomerate=True,
                     Must point to SQL database containing the synapse data. If
                     not provided will look for a ```BUHMANN_SYNAPSE_DB``
                     environment variable.
+    max_threads :   int
+                    Number of threads to use for mapping synapses to neurons.
 
     Return
     ------
@@ -532,20 +964,19 @@ def get_neuron_connections(sources, targets=None, agglomerate=True,
 
     # Get segments for this neuron(s)
     unique_neurons = (sources + targets).remove_duplicates(key='id')
-    seg_ids = google.neuron_to_segments(unique_neurons)
-
-    # Drop segments with overlap below threshold
-    if ol_thresh:
-        seg_ids = seg_ids.loc[seg_ids.max(axis=1) >= ol_thresh]
+    overlap = google.neuron_to_segments(unique_neurons, sparse=True)
 
     # We need to make sure that every segment ID is only attributed to a single
     # neuron
-    is_top = seg_ids.values != seg_ids.max(axis=1).values.reshape((seg_ids.shape[0], 1))
-    where_top = np.where(is_top)
-    seg_ids.values[where_top] = 0  # do not change this to None
+    overlap = top_owners(overlap, id_col='skeleton_id', seg_col='seg_id',
+                         ties=False)
+
+    # Drop segments with overlap below threshold
+    if ol_thresh:
+        overlap = overlap[overlap.counts >= ol_thresh]
 
-    pre_ids = seg_ids.loc[seg_ids[sources.id].max(axis=1) > 0].index.values
-    post_ids = seg_ids.loc[seg_ids[targets.id].max(axis=1) > 0].index.values
+    pre_ids = overlap.seg_id.values[overlap.skeleton_id.isin(sources.id).values]
+    post_ids = overlap.seg_id.values[overlap.skeleton_id.isin(targets.id).values]
 
     # Fetch pre- and postsynapses associated with these segments
     # It's cheaper to get them all in one go
@@ -554,8 +985,7 @@ def get_neuron_connections(sources, targets=None, agglomerate=True,
                             db=None)
 
     # Now associate synapses with neurons
-    seg2neuron = dict(zip(seg_ids.index.values,
-                          seg_ids.columns[np.argmax(seg_ids.values, axis=1)]))
+    seg2neuron = dict(zip(overlap.seg_id.values, overlap.skeleton_id.values))
 
     syn['id_pre'] = syn.segmentid_pre.map(seg2neuron)
     syn['id_post'] = syn.segmentid_post.map(seg2neuron)
@@ -568,23 +998,32 @@ def get_neuron_connections(sources, targets=None, agglomerate=True,
 
     # Next drop synapses far away from our neurons
     if dist_thresh:
-        syn['pre_close'] = False
-        syn['post_close'] = False
-        for id in np.unique(syn[['id_pre', 'id_post']].values.flatten()):
-            neuron = unique_neurons.idx[id]
-            tree = navis.neuron2KDTree(neuron)
-
-            is_pre = syn.id_pre == id
-            if np.any(is_pre):
-                dist, ix = tree.query(syn.loc[is_pre, ['pre_x', 'pre_y', 'pre_z']].values,
-                                      distance_upper_bound=dist_thresh)
-                syn.loc[is_pre, 'pre_close'] = dist < float('inf')
-
-            is_post = syn.id_post == id
-            if np.any(is_post):
-                dist, ix = tree.query(syn.loc[is_post, ['post_x', 'post_y', 'post_z']].values,
-                                      distance_upper_bound=dist_thresh)
-                syn.loc[is_post, 'post_close'] = dist < float('inf')
+        pre_close = np.zeros(syn.shape[0], dtype=bool)
+        post_close = np.zeros(syn.shape[0], dtype=bool)
+
+        # Rows for each neuron as pre- and postsynaptic partner
+        pre_rows = syn.groupby('id_pre').indices
+        post_rows = syn.groupby('id_post').indices
+        ids = np.unique(list(pre_rows) + list(post_rows))
+        empty = np.zeros(0, dtype=int)
+
+        # Query pre- and postsynaptic sites for all neurons in parallel
+        pre_locs = syn[['pre_x', 'pre_y', 'pre_z']].values
+        post_locs = syn[['post_x', 'post_y', 'post_z']].values
+        locs = [np.vstack((pre_locs[pre_rows.get(id, empty)],
+                           post_locs[post_rows.get(id, empty)])) for id in ids]
+        res = closest_nodes([unique_neurons.idx[id] for id in ids], locs,
+                            max_threads=max_threads,
+                            distance_upper_bound=dist_thresh)
+
+        for id, (dist, ix) in zip(ids, res):
+            is_pre = pre_rows.get(id, empty)
+            is_post = post_rows.get(id, empty)
+            pre_close[is_pre] = dist[:len(is_pre)] < float('inf')
+            post_close[is_post] = dist[len(is_pre):] < float('inf')
+
+        syn['pre_close'] = pre_close
+        syn['post_close'] = post_close
 
         # Drop connections where either pre- or postsynaptic site are too far
         # away from the neuron
@@ -595,28 +1034,8 @@ def get_neuron_connections(sources, targets=None, agglomerate=True,
     dupl_thresh = 250
     if drop_duplicates:
         # We are dealing with this from a presynaptic perspective
-        while True:
-            pre_tree = cKDTree(syn[['pre_x', 'pre_y', 'pre_z']].values)
-            pairs = pre_tree.query_pairs(r=dupl_thresh, output_type='ndarray')
-
-            same_pre = syn.iloc[pairs[:, 0]].segmentid_pre.values == syn.iloc[pairs[:, 1]].segmentid_pre.values
-            same_post = syn.iloc[pairs[:, 0]].segmentid_post.values == syn.iloc[pairs[:, 1]].segmentid_post.values
-            same_cn = same_pre & same_post
-
-            # If no more pairs to collapse break
-            if same_cn.sum() == 0:
-                break
-
-            # Generate a graph from pairs
-            G = nx.Graph()
-            G.add_edges_from(pairs[same_cn])
-
-            # Find the minimum number of nodes we need to remove
-            # to separate the connectors
-            to_rm = []
-            for cn in nx.connected_components(G):
-                to_rm += list(nx.minimum_node_cut(nx.subgraph(G, cn)))
-            syn = syn.drop(index=syn.index.values[to_rm])
+        syn = syn[drop_duplicate_synapses(syn, dist=dupl_thresh,
+                                          use_post=False)]
 
     if agglomerate:
         edges = syn.groupby(['id_pre', 'id_post'],
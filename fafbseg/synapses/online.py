@@ -26,6 +26,7 @@ from tqdm.auto import tqdm
 
 from .utils import assign_connectors
 from .. import google, spine
+from ..utils import top_owners
 
 conn = None
 
@@ -116,23 +117,20 @@ def get_neuron_synapses(x, pre=True, post=True, collapse_connectors=False,
     if not isinstance(x, navis.NeuronList):
         x = navis.NeuronList([x])
 
-    # Get segments for this neuron(s)
-    seg_ids = google.neuron_to_segments(x)
+    # Get segments for this neuron(s) as sparse (neuron, segment, counts)
+    overlap = google.neuron_to_segments(x, sparse=True)
+
+    # We will make sure that every segment ID is only attributed to a single
+    # neuron (or several in case of ties)
+    overlap = top_owners(overlap, id_col='skeleton_id', seg_col='seg_id')
 
     # Drop segments with overlap below threshold
     if ol_thresh:
-        seg_ids = seg_ids.loc[seg_ids.max(axis=1) >= ol_thresh]
-
-    # We will make sure that every segment ID is only attributed to a single
-    # neuron
-    not_top = seg_ids.values != seg_ids.max(axis=1).values.reshape((seg_ids.shape[0], 1))
-    where_not_top = np.where(not_top)
-    if np.any(where_not_top[0]):
-        seg_ids.values[where_not_top] = None  # do not change this to 0
+        overlap = overlap[overlap.counts >= ol_thresh]
 
     # Fetch pre- and postsynapses associated with these segments
     # It's cheaper to get them all in one go
-    syn = query_synapses(seg_ids.index.values,
+    syn = query_synapses(overlap.seg_id.unique(),
                          score_thresh=score_thresh,
                          ret=ret if ret != 'catmaid' else 'brief',
                          db=None)
@@ -189,11 +187,13 @@ def get_neuron_synapses(x, pre=True, post=True, collapse_connectors=False,
 
     # Now associate synapses with neurons
     tables = []
-    for c in tqdm(seg_ids.columns,
-                  desc='Proc. neurons',
-                  disable=not progress or seg_ids.shape[1] == 1,
-                  leave=False):
-        this_segs = seg_ids.loc[seg_ids[c].notnull(), c]
+    by_neuron = overlap.groupby('skeleton_id')
+    for c, this in tqdm(by_neuron,
+                        desc='Proc. neurons',
+                        total=by_neuron.ngroups,
+                        disable=not progress or by_neuron.ngroups == 1,
+                        leave=False):
+        this_segs = pd.Series(this.counts.values, index=this.seg_id.values)
         is_pre = syn.segmentid_pre.isin(this_segs.index.values)
         is_post = syn.segmentid_post.isin(this_segs.index.values)
 
@@ -207,8 +207,8 @@ def get_neuron_synapses(x, pre=True, post=True, collapse_connectors=False,
         if any(is_dupl):
             dupl = syn[is_dupl]
             # Next get the overlap counts for the pre- and postsynaptic seg IDs
-            dupl_pre_ol = seg_ids.loc[dupl.segmentid_pre, c].values
-            dupl_post_ol = seg_ids.loc[dupl.segmentid_post, c].values
+            dupl_pre_ol = this_segs.loc[dupl.segmentid_pre].values
+            dupl_post_ol = this_segs.loc[dupl.segmentid_post].values
 
             # We go for the one with more overlap
             true_pre = dupl_pre_ol > dupl_post_ol
@@ -350,20 +350,19 @@ def get_neuron_connections(sources, targets=None, agglomerate=True,
 
     # Get segments for this neuron(s)
     unique_neurons = (sources + targets).remove_duplicates(key='id')
-    seg_ids = google.neuron_to_segments(unique_neurons)
-
-    # Drop segments with overlap below threshold
-    if ol_thresh:
-        seg_ids = seg_ids.loc[seg_ids.max(axis=1) >= ol_thresh]
+    overlap = google.neuron_to_segments(unique_neurons, sparse=True)
 
     # We need to make sure that every segment ID is only attributed to a single
     # neuron
-    is_top = seg_ids.values != seg_ids.max(axis=1).values.reshape((seg_ids.shape[0], 1))
-    where_top = np.where(is_top)
-    seg_ids.values[where_top] = 0  # do not change this to None
+    overlap = top_owners(overlap, id_col='skeleton_id', seg_col='seg_id',
+                         ties=False)
+
+    # Drop segments with overlap below threshold
+    if ol_thresh:
+        overlap = overlap[overlap.counts >= ol_thresh]
 
-    pre_ids = seg_ids.loc[seg_ids[sources.id].max(axis=1) > 0].index.values
-    post_ids = seg_ids.loc[seg_ids[targets.id].max(axis=1) > 0].index.values
+    pre_ids = overlap.seg_id.values[overlap.skeleton_id.isin(sources.id).values]
+    post_ids = overlap.seg_id.values[overlap.skeleton_id.isin(targets.id).values]
 
     # Fetch pre- and postsynapses associated with these segments
     # It's cheaper to get them all in one go
@@ -372,8 +371,7 @@ def get_neuron_connections(sources, targets=None, agglomerate=True,
                             db=None)
 
     # Now associate synapses with neurons
-    seg2neuron = dict(zip(seg_ids.index.values,
-                          seg_ids.columns[np.argmax(seg_ids.values, axis=1)]))
+    seg2neuron = dict(zip(overlap.seg_id.values, overlap.skeleton_id.values))
 
     syn['id_pre'] = syn.segmentid_pre.map(seg2neuron)
     syn['id_post'] = syn.segmentid_post.map(seg2neuron)
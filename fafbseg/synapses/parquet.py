@@ -0,0 +1,114 @@
+#    A collection of tools to interface with manually traced and autosegmented
+#    data in FAFB.
+#
+#    Copyright (C) 2019 Philipp Schlegel
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+
+"""Parquet storage backend for the offline synapse data."""
+
+import os
+
+import pyarrow.dataset as ds
+
+__all__ = ['ParquetStore']
+
+
+class ParquetStore:
+    """Synapse table stored as (partitioned) Parquet dataset.
+
+    Queries are run via ``pyarrow.dataset`` with filters pushed down to the
+    Parquet reader: row groups whose statistics don't match the query are
+    skipped. Use :func:`fafbseg.synapses.offline.sqlite_to_parquet` to
+    generate a dataset sorted by segment ID.
+
+    Parameters
+    ----------
+    path :      str
+                Directory with Parquet files or a single Parquet file.
+
+    """
+
+    def __init__(self, path):
+        """Initialize."""
+        self.path = os.path.abspath(os.path.expanduser(path))
+
+        if not os.path.exists(self.path):
+            raise ValueError(f'Parquet synapse store "{self.path}" does not exist')
+
+        self.dataset = ds.dataset(self.path, format='parquet',
+                                  partitioning='hive')
+
+    def __repr__(self):
+        return f'<ParquetStore "{self.path}">'
+
+    def query(self, pre_ids=None, post_ids=None, how='or', columns=None,
+              score_thresh=None, dtypes=None, iterator=False, chunksize=100000):
+        """Query synapses.
+
+        Parameters
+        ----------
+        pre_ids/post_ids :  list of int, optional
+                            Pre- and postsynaptic segment IDs.
+        how :               "or" | "and"
+                            Whether synapses have to match pre- OR postsynaptic
+                            IDs, or both.
+        columns :           list of str, optional
+                            Columns to return. If None, return all columns.
+        score_thresh :      int, optional
+                            Minimum cleft score.
+        dtypes :            dict, optional
+                            Data types to convert columns to.
+        iterator :          bool
+                            If True, return generator of DataFrames.
+        chunksize :         int
+                            Number of rows per DataFrame if ``iterator=True``.
+
+        Returns
+        -------
+        pandas.DataFrame | generator
+
+        """
+        filters = []
+        if pre_ids is not None:
+            filters.append(ds.field('segmentid_pre').isin(list(map(int, pre_ids))))
+        if post_ids is not None:
+            filters.append(ds.field('segmentid_post').isin(list(map(int, post_ids))))
+
+        if not filters:
+            raise ValueError('Must provide pre- and/or postsynaptic IDs')
+
+        expr = filters[0]
+        for f in filters[1:]:
+            expr = (expr | f) if how == 'or' else (expr & f)
+
+        if score_thresh:
+            expr = expr & (ds.field('cleft_scores') >= score_thresh)
+
+        if iterator:
+            batches = self.dataset.to_batches(columns=columns, filter=expr,
+                                              batch_size=int(chunksize))
+            return (_to_pandas(b, dtypes) for b in batches if b.num_rows)
+
+        table = self.dataset.to_table(columns=columns, filter=expr)
+
+        return _to_pandas(table, dtypes)
+
+
+def _to_pandas(table, dtypes=None):
+    """Convert Arrow table/batch to pandas and fix data types."""
+    df = table.to_pandas()
+
+    if dtypes:
+        to_conv = {k: v for k, v in dtypes.items() if k in df.columns}
+        df = df.astype(to_conv, errors='ignore')
+
+    return df
@@ -87,20 +87,23 @@ def collapse_nt_predictions(pred, single_pred=False, id_col=None):
     """
 
     if id_col is not None:
-        # Collapse predictions for every unique value of id_col
-        ids = pred[id_col].unique()
-        res = {i: collapse_nt_predictions(pred[pred[id_col] == i],
-                                          single_pred=single_pred) for i in ids}
+        # Collapse predictions for every unique value of id_col in one go
+        ids, sums, weights = weighted_nt_sums(pred, id_col=id_col)
 
-        # Combine results
-        if not single_pred:
-            # Label series and combine
-            for r in res:
-                res[r].name = r
+        if len(ids) < pred[id_col].nunique():
+            raise ValueError('No synapses with transmitter predictions.')
 
-            res = pd.concat(list(res.values()), join='outer', axis=1).fillna(0)
+        conf = nt_confidence(sums, weights)
 
-        return res
+        if single_pred:
+            top_ix = np.argmax(conf, axis=1)
+            top_conf = conf[np.arange(len(ids)), top_ix]
+            # IDs without cleft scores get an (integer) 0 - same as for
+            # single IDs
+            return {i: (trans[t], c if w > 0 else np.int64(0))
+                    for i, t, c, w in zip(ids, top_ix, top_conf, weights)}
+
+        return pd.DataFrame(conf.T, index=trans, columns=ids)
 
     # Drop NAs (some synapses have no prediction)
     pred = pred[pred[trans].any(axis=1)]
@@ -123,6 +126,58 @@ def collapse_nt_predictions(pred, single_pred=False, id_col=None):
     return pred_weight
 
 
+def weighted_nt_sums(pred, id_col):
+    """Sum up cleft score-weighted predictions per ID.
+
+    Parameters
+    ----------
+    pred :      pd.DataFrame
+                Table with synapse neurotransmitter predictions.
+    id_col :    str
+                Column in ``pred`` to group by.
+
+    Returns
+    -------
+    ids :       np.ndarray
+                Unique IDs in order of first appearance in ``pred``. IDs
+                without any predictions are dropped.
+    sums :      np.ndarray
+                (N, 6) array of weighted sums for each transmitter (in the
+                order of ``trans``).
+    weights :   np.ndarray
+                (N, ) array of summed cleft scores.
+
+    """
+    # Order of first appearance (including synapses without prediction)
+    order = pd.unique(pred[id_col])
+
+    # Drop NAs (some synapses have no prediction)
+    pred = pred[pred[trans].any(axis=1)]
+
+    w = pred.cleft_scores.values.astype(np.float64)
+    weighted = pd.DataFrame(pred[trans].values * w[:, None], columns=trans)
+    weighted['_weight'] = w
+    weighted['_id'] = pred[id_col].values
+
+    grp = weighted.groupby('_id', sort=False).sum()
+    ix = grp.index.get_indexer(order)
+    grp = grp.iloc[ix[ix >= 0]]
+
+    return grp.index.values, grp[trans].values, grp['_weight'].values
+
+
+def nt_confidence(sums, weights):
+    """Turn weighted sums into confidences (0 where there are no weights)."""
+    sums = np.asarray(sums, dtype=np.float64)
+    weights = np.asarray(weights, dtype=np.float64)
+
+    conf = np.zeros(sums.shape, dtype=np.float64)
+    has_weight = weights > 0
+    conf[has_weight] = sums[has_weight] / weights[has_weight, None]
+
+    return conf
+
+
 def plot_nt_predictions(pred, bins=20, id_col=None, ax=None, legend=True, **kwargs):
     """Plot neurotransmitter predictions.
 
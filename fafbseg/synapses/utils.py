@@ -15,14 +15,210 @@
 
 """Utility functions to work with synapse data."""
 
-import networkx as nx
+import navis
+import threading
+import weakref
+
 import numpy as np
 import pandas as pd
 
+from concurrent.futures import ThreadPoolExecutor
+from scipy import sparse
+from scipy.sparse import csgraph
 from scipy.spatial import cKDTree
 from tqdm.auto import tqdm
 
-__all__ = ['assign_connectors', 'process_synapse_table', 'catmaid_table']
+__all__ = ['assign_connectors', 'process_synapse_table', 'catmaid_table',
+           'drop_duplicate_synapses']
+
+# KD-trees for neurons' nodes: {id(nodes): (weakref(nodes), tree)}
+_KDTREES = {}
+_KDTREES_LOCK = threading.Lock()
+
+
+def get_kdtree(neuron):
+    """Return (cached) KD-tree for a TreeNeuron's nodes.
+
+    Trees are cached by identity of the neuron's node table and are rebuilt
+    if the node coordinates (including their order) differ from the ones the
+    tree was built with. Entries are dropped when the node table is garbage
+    collected.
+
+    Parameters
+    ----------
+    neuron :    navis.TreeNeuron
+
+    Returns
+    -------
+    scipy.spatial.cKDTree
+
+    """
+    nodes = neuron.nodes
+    locs = np.asarray(nodes[['x', 'y', 'z']].values, dtype=np.float64)
+    key = id(nodes)
+
+    with _KDTREES_LOCK:
+        cached = _KDTREES.get(key, None)
+    # Compare the actual coordinates: sorting or editing the node table in
+    # place would otherwise leave us with a tree pointing to the wrong rows
+    if cached and cached[0]() is nodes \
+       and np.array_equal(cached[1].data, locs, equal_nan=True):
+        return cached[1]
+
+    tree = cKDTree(locs)
+
+    ref = weakref.ref(nodes, lambda r, key=key: _KDTREES.pop(key, None))
+    with _KDTREES_LOCK:
+        _KDTREES[key] = (ref, tree)
+
+    return tree
+
+
+def closest_nodes(neurons, locs, max_threads=4, **kwargs):
+    """Find closest nodes for each neuron's set of locations.
+
+    KD-trees are taken from the cache (see :func:`get_kdtree`) and queries
+    are run in a thread pool - ``cKDTree`` releases the GIL.
+
+    Parameters
+    ----------
+    neurons :       list of navis.TreeNeuron
+    locs :          list of (N, 3) arrays
+                    Locations to query for each neuron.
+    max_threads :   int
+                    Number of threads. For a single neuron, the query is
+                    instead parallelized with ``workers=-1``.
+    **kwargs
+                    Keyword arguments are passed to ``cKDTree.query``.
+
+    Returns
+    -------
+    list of (dist, ix) tuples
+                    ``ix`` are indices into each neuron's node table.
+
+    """
+    def query(n, l, workers):
+        l = np.asarray(l).reshape(-1, 3)
+        if not len(l):
+            return np.zeros(0), np.zeros(0, dtype=int)
+        return get_kdtree(n).query(l, workers=workers, **kwargs)
+
+    neurons = list(neurons)
+    if len(neurons) == 1 or max_threads <= 1:
+        return [query(n, l, -1) for n, l in zip(neurons, locs)]
+
+    with ThreadPoolExecutor(max_workers=max_threads) as executor:
+        futures = [executor.submit(query, n, l, 1) for n, l in zip(neurons, locs)]
+        return [f.result() for f in futures]
+
+
+def drop_duplicate_synapses(syn, pre_col='segmentid_pre',
+                            post_col='segmentid_post', dist=250,
+                            use_post=True, score_col='cleft_scores'):
+    """Find duplicate synapses in a single pass.
+
+    Synapses are considered duplicates if they connect the same pair of
+    pre- and postsynaptic IDs and their presynaptic (or postsynaptic if
+    ``use_post=True``) sites are within ``dist`` of each other. Chains of
+    duplicates are collapsed into a single cluster of which we keep the
+    synapse with the highest ``score_col`` (ties are broken by order in
+    the table, i.e. the result is deterministic). Synapses with missing
+    (NaN) or background (0) pre- or postsynaptic IDs are never considered
+    duplicates and are always kept.
+
+    Parameters
+    ----------
+    syn :           pandas.DataFrame
+                    Synapse table. Must contain ``pre_x/y/z``, ``post_x/y/z``
+                    (if ``use_post=True``), ``pre_col`` and ``post_col``.
+    pre_col/post_col : str
+                    Columns with pre- and postsynaptic IDs.
+    dist :          int | float
+                    Max distance between duplicates.
+    use_post :      bool
+                    If True, synapses whose presynaptic OR postsynaptic sites
+                    are close are considered duplicates. If False, only
+                    presynaptic sites are considered.
+    score_col :     str, optional
+                    Column used to decide which synapse to keep.
+
+    Returns
+    -------
+    keep :          np.ndarray
+                    Boolean array - True for synapses to keep.
+
+    """
+    n = syn.shape[0]
+    keep = np.ones(n, dtype=bool)
+
+    # Unmapped (NaN) or background (0) IDs are carried through unchanged
+    ids = syn[[pre_col, post_col]]
+    valid = (ids.notnull() & (ids != 0)).all(axis=1).values
+    if valid.sum() < 2:
+        return keep
+    if not np.all(valid):
+        keep[valid] = drop_duplicate_synapses(syn[valid],
+                                              pre_col=pre_col,
+                                              post_col=post_col,
+                                              dist=dist,
+                                              use_post=use_post,
+                                              score_col=score_col)
+        return keep
+
+    # Group synapses by their (pre, post) pair - only synapses within the
+    # same group can be duplicates
+    group = syn.groupby([pre_col, post_col], sort=False).ngroup().values
+
+    pairs = [_close_pairs(syn[['pre_x', 'pre_y', 'pre_z']].values, group, dist)]
+    if use_post:
+        pairs.append(_close_pairs(syn[['post_x', 'post_y', 'post_z']].values,
+                                  group, dist))
+    labels = _connected_components(np.vstack(pairs), n)
+
+    # Keep the highest scoring synapse per cluster
+    if score_col and score_col in syn.columns:
+        score = syn[score_col].values
+    else:
+        score = np.zeros(n)
+    order = np.lexsort((np.arange(n), -score, labels))
+    is_first = np.ones(n, dtype=bool)
+    is_first[1:] = labels[order[1:]] != labels[order[:-1]]
+
+    keep[:] = False
+    keep[order[is_first]] = True
+
+    return keep
+
+
+def _close_pairs(locs, group, dist):
+    """Find pairs of locations within ``dist`` that belong to the same group.
+
+    Uses a single KD-tree for all groups: locations are shifted along the
+    x-axis by a per-group offset that is larger than the extent of the data,
+    such that locations from different groups can never pair up.
+
+    """
+    locs = np.asarray(locs, dtype=np.float64).copy()
+    if not len(locs):
+        return np.zeros((0, 2), dtype=int)
+
+    offset = np.nanmax(locs[:, 0]) - np.nanmin(locs[:, 0]) + 2 * dist + 1
+    locs[:, 0] += group * offset
+
+    tree = cKDTree(locs)
+    pairs = tree.query_pairs(r=dist, output_type='ndarray')
+
+    # Just to be safe with floating point precision
+    return pairs[group[pairs[:, 0]] == group[pairs[:, 1]]]
+
+
+def _connected_components(pairs, n):
+    """Get connected component label for each of ``n`` nodes."""
+    graph = sparse.coo_matrix((np.ones(len(pairs), dtype=bool),
+                               (pairs[:, 0], pairs[:, 1])),
+                              shape=(n, n))
+    _, labels = csgraph.connected_components(graph, directed=False)
+    return labels
 
 
 def catmaid_table(cn_table, query_ids):
@@ -123,44 +319,8 @@ def process_synapse_table(syn,  min_score=30, dist_thresh=1000, drop_autapses=Tr
 
     # Drop duplicates
     if drop_duplicates:
-        dupl_thresh = 250
-        # This is done iteratively
-        while True:
-            # Generate pairs of pre- and postsynaptic coordinates that are
-            # suspiciously close
-            pre_tree = cKDTree(syn[['pre_x', 'pre_y', 'pre_z']].values)
-            post_tree = cKDTree(syn[['post_x', 'post_y', 'post_z']].values)
-            pre_pairs = pre_tree.query_pairs(r=dupl_thresh)
-            post_pairs = post_tree.query_pairs(r=dupl_thresh)
-
-            # We consider pairs for removal where pre- OR postsynapse are close
-            # Alternatively, we could also look for cases where both pre- AND
-            # postsynapse must be too close for comfort
-            # This behaviour is easy to change via below operator
-            pairs = pre_pairs | post_pairs  # union of both
-            pairs = np.array(list(pairs))
-
-            # For each pair check if they connect the same IDs
-            same_pre = syn.iloc[pairs[:, 0]].pre.values == syn.iloc[pairs[:, 1]].pre.values
-            same_post = syn.iloc[pairs[:, 0]].post.values == syn.iloc[pairs[:, 1]].post.values
-            same_cn = same_pre & same_post
-
-            # If no more pairs to collapse break loop
-            if same_cn.sum() == 0:
-                break
-
-            # Generate a graph from pairs
-            G = nx.Graph()
-            G.add_edges_from(pairs[same_cn])
-
-            # Find the minimum number of nodes we need to remove
-            # to separate the connectors
-            to_rm = []
-            for cn in nx.connected_components(G):
-                to_rm += list(nx.minimum_node_cut(nx.subgraph(G, cn)))
-
-            # Drop those nodes
-            syn = syn.drop(index=syn.index.values[to_rm])
+        syn = syn[drop_duplicate_synapses(syn, pre_col='pre', post_col='post',
+                                          dist=250)]
         # Reset index so it's continuous again
         syn.reset_index(drop=True, inplace=True)
 
@@ -264,11 +424,11 @@ def process_synapse_table(syn,  min_score=30, dist_thresh=1000, drop_autapses=Tr
 def assign_connectors(synapses, max_dist=300):
     """Collapse synapses by presynaptic connectors.
 
-    1. Iterate over each unique presynaptic segment ID and ...
-    2. Form pairs of presynapses that are within ``max_dist``
-    3. Use these pairs to create a network graph
-    4. Break graph into connected components
-    3. Give a unique connector ID to all synapses in a connected component
+    1. Sort synapses by presynaptic segment ID
+    2. Form pairs of presynapses of the same segment that are within
+       ``max_dist`` (using a single KD-tree for all segments)
+    3. Break pairs into connected components
+    4. Give a unique connector ID to all synapses in a connected component
 
     Parameters
     ----------
@@ -293,35 +453,20 @@ def assign_connectors(synapses, max_dist=300):
     else:
         raise ValueError('Need either pre_x/pre_y/pre_z or x/y/z columns.')
 
-    # Iterate over presynaptic IDs
-    cn_id_counter = 1
-    synapses['connector_id'] = None
-    for sid in tqdm(synapses.segmentid_pre.unique(),
-                    leave=False,
-                    desc='Collapsing synapses'):
-        this_sid = synapses.segmentid_pre == sid
-        this = synapses[this_sid]
-
-        if this.shape[0] == 1:
-            synapses.loc[this_sid, 'connector_id'] = cn_id_counter
-            cn_id_counter += 1
-            continue
-
-        # Build KDTree and generate pairs
-        this_locs = this[loc_cols].values
-        tree = cKDTree(this_locs)
-        pairs = tree.query_pairs(r=max_dist)
-
-        # Generate graph from pairs
-        G = nx.Graph()
-        G.add_nodes_from(np.arange(this.shape[0]))  # this is for lone synapses
-        G.add_edges_from(pairs)
-
-        this_cn_ids = np.zeros(this.shape[0])
-        for cc in nx.connected_components(G):
-            this_cn_ids[list(cc)] = cn_id_counter
-            cn_id_counter += 1
-
-        synapses.loc[this_sid, 'connector_id'] = this_cn_ids
-
-    synapses['connector_id'] = synapses.connector_id.astype(np.int32)
+    if synapses.empty:
+        synapses['connector_id'] = np.zeros(0, dtype=np.int32)
+        return
+
+    # Sort by presynaptic segment (in order of appearance) such that
+    # connector IDs are contiguous per segment
+    group, _ = pd.factorize(synapses.segmentid_pre)
+    order = np.argsort(group, kind='stable')
+
+    pairs = _close_pairs(synapses[loc_cols].values[order], group[order],
+                         max_dist)
+    labels = _connected_components(pairs, len(order))
+
+    cn_ids = np.zeros(len(order), dtype=np.int32)
+    cn_ids[order] = labels + 1
+
+    synapses['connector_id'] = cn_ids
@@ -14,6 +14,9 @@
 #    GNU General Public License for more details.
 """Collection of utility functions."""
 
+import numpy as np
+import pandas as pd
+
 from functools import wraps
 from urllib.parse import urlparse
 
@@ -53,3 +56,79 @@ def is_url(x):
         return all([result.scheme, result.netloc, result.path])
     except BaseException:
         return False
+
+
+def overlap_counts(ids, seg_ids, id_col='id', seg_col='seg_id'):
+    """Count overlap between IDs (e.g. neurons) and segment IDs.
+
+    Parameters
+    ----------
+    ids :       array-like
+                ID (e.g. neuron/skeleton ID) for each location.
+    seg_ids :   array-like
+                Segment ID for each location. Segment ID 0 is ignored.
+    id_col :    str
+                Name of the ID column in the returned table.
+    seg_col :   str
+                Name of the segment ID column in the returned table.
+
+    Returns
+    -------
+    pandas.DataFrame
+                Sparse (COO) overlap table with one row per ID and segment
+                ID pair, sorted by ID and segment ID::
+
+                    id_col  seg_col  counts
+                 0   ...      ...       5
+
+    """
+    ids = np.asarray(ids)
+    seg_ids = np.asarray(seg_ids)
+
+    not_zero = seg_ids != 0
+    id_codes, id_uni = pd.factorize(ids[not_zero], sort=True)
+    seg_codes, seg_uni = pd.factorize(seg_ids[not_zero], sort=True)
+
+    # Count unique (id, seg_id) combinations
+    pairs = id_codes.astype(np.int64) * len(seg_uni) + seg_codes
+    pairs, counts = np.unique(pairs, return_counts=True)
+
+    return pd.DataFrame({id_col: np.asarray(id_uni)[pairs // max(len(seg_uni), 1)],
+                         seg_col: np.asarray(seg_uni)[pairs % max(len(seg_uni), 1)],
+                         'counts': counts})
+
+
+def top_owners(overlap, id_col='id', seg_col='seg_id', ties=True):
+    """Attribute each segment to the ID(s) with the most overlap.
+
+    Parameters
+    ----------
+    overlap :   pandas.DataFrame
+                Sparse overlap table as returned by :func:`overlap_counts`.
+    id_col :    str
+                Name of the ID column.
+    seg_col :   str
+                Name of the segment ID column.
+    ties :      bool
+                If True, segments are attributed to all IDs with the max
+                overlap. If False, only to the first (i.e. the lowest) ID.
+
+    Returns
+    -------
+    pandas.DataFrame
+                Subset of ``overlap`` with only the top owners.
+
+    """
+    top_counts = overlap.groupby(seg_col).counts.transform('max')
+    top = overlap[overlap.counts.values == top_counts.values]
+
+    if not ties:
+        top = top.sort_values(id_col, kind='stable')
+        top = top.drop_duplicates(seg_col, keep='first').sort_index()
+
+    return top
+
+
+def overlap_matrix(overlap, id_col='id', seg_col='seg_id'):
+    """Turn sparse overlap table into a dense segment x ID matrix."""
+    return overlap.pivot(index=seg_col, columns=id_col, values='counts')
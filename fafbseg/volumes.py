@@ -0,0 +1,240 @@
+#    A collection of tools to interface with manually traced and autosegmented
+#    data in FAFB.
+#
+#    Copyright (C) 2019 Philipp Schlegel
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+
+"""Point look-ups against local copies of precomputed segmentation volumes."""
+
+import collections
+import navis
+import os
+import threading
+
+import cloudvolume
+import numpy as np
+
+from concurrent.futures import ThreadPoolExecutor
+
+__all__ = ['LocalVolume']
+
+# Size of "voxel" coordinates used throughout fafbseg
+VOXEL_SIZE = np.array([4, 4, 40])
+
+
+class LocalVolume:
+    """Look up segment IDs at given locations in a local precomputed volume.
+
+    Points are grouped by the storage chunk they fall into, each chunk is
+    decoded only once (chunks are kept in a LRU cache for subsequent
+    queries) and values are gathered via vectorized indexing. Decoding
+    happens in a thread pool - the volume is never pickled.
+
+    Parameters
+    ----------
+    path :          str
+                    Path to the local copy of the volume. Must point to the
+                    directory with the ``info`` file.
+    mip :           int
+                    Scale to query.
+    cache_size :    int
+                    Max number of decoded chunks to keep in memory.
+    max_threads :   int
+                    Number of threads used to decode chunks.
+    dataset :       str, optional
+                    Name of the dataset this is a copy of. Used to check
+                    that queries go against the right data.
+    **kwargs
+                    Keyword arguments passed on to ``cloudvolume.CloudVolume``.
+
+    Examples
+    --------
+    >>> from fafbseg.volumes import LocalVolume
+    >>> vol = LocalVolume('/Volumes/SSD/segmentation')
+    >>> vol.lookup([[133131, 55615, 3289], [132802, 55661, 3289]])
+
+    """
+
+    def __init__(self, path, mip=0, cache_size=256, max_threads=4,
+                 dataset=None, **kwargs):
+        """Initialize."""
+        if 'CloudVolume' in str(type(path)):
+            self.volume = path
+        else:
+            path = str(path)
+            if '://' not in path:
+                path = 'file://' + os.path.abspath(os.path.expanduser(path))
+
+            # Set and update defaults from kwargs
+            defaults = dict(mip=mip,
+                            fill_missing=True,
+                            bounded=False,
+                            cache=False,
+                            parallel=1,
+                            progress=False)
+            defaults.update(kwargs)
+
+            self.volume = cloudvolume.CloudVolume(path, **defaults)
+
+        self.dataset = dataset
+        self.mip = self.volume.mip
+        self.cache_size = int(cache_size)
+        self.max_threads = max(int(max_threads), 1)
+
+        self.resolution = np.asarray(self.volume.resolution, dtype=np.float64)
+        self.chunk_size = np.asarray(self.volume.chunk_size, dtype=np.int64)
+        self.offset = np.asarray(self.volume.voxel_offset, dtype=np.int64)
+        self.shape = np.asarray(self.volume.volume_size, dtype=np.int64)
+        self.grid = -(-self.shape // self.chunk_size)
+
+        self._cache = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return (f'<LocalVolume "{self.volume.cloudpath}" mip={self.mip} '
+                f'resolution={self.resolution.tolist()} '
+                f'cached_chunks={len(self._cache)}>')
+
+    def clear_cache(self):
+        """Drop all decoded chunks from the cache."""
+        with self._lock:
+            self._cache.clear()
+
+    def lookup(self, locs, coordinates='voxel', progress=True):
+        """Fetch segment IDs at given locations.
+
+        Parameters
+        ----------
+        locs :          list-like
+                        Array of x/y/z coordinates.
+        coordinates :   "voxel" | "nm"
+                        Units in which your coordinates are in. "voxel" is
+                        assumed to be 4x4x40 (x/y/z) nanometers.
+        progress :      bool
+                        Whether to show a progress bar.
+
+        Returns
+        -------
+        numpy.array
+                        Segment IDs in the same order as ``locs``. Locations
+                        outside the volume are returned with ID 0.
+
+        """
+        locs = np.asarray(locs, dtype=np.float64)
+        if locs.ndim == 1 and len(locs) == 3:
+            locs = locs.reshape((1, 3))
+        elif locs.ndim != 2 or locs.shape[1] != 3:
+            raise ValueError('Expected x/y/z coordinates as array of shape (N, 3)')
+
+        if coordinates in ('nm', 'nanometer', 'nanometers', 'nanometre',
+                           'nanometres'):
+            # Round to voxels just like the spine service does
+            locs = np.round(locs / VOXEL_SIZE)
+        elif coordinates not in ('vxl', 'voxel', 'voxels'):
+            raise ValueError(f'Unknown coordinates: "{coordinates}"')
+
+        # Voxel coordinates (at this volume's resolution) relative to the
+        # volume's origin
+        vxl = np.floor(locs * VOXEL_SIZE / self.resolution).astype(np.int64)
+        vxl -= self.offset
+
+        data = np.zeros(len(vxl), dtype=self.volume.dtype)
+
+        in_bounds = np.all((vxl >= 0) & (vxl < self.shape), axis=1)
+        if not np.any(in_bounds):
+            return data
+
+        in_ix = np.where(in_bounds)[0]
+        chunks, groups = group_by_chunk(vxl[in_bounds], self.chunk_size,
+                                        self.grid)
+
+        def _gather(chunk_ix, ix):
+            chunk, start = self._get_chunk(chunk_ix)
+            rel = vxl[in_ix[ix]] - start
+            return in_ix[ix], chunk[rel[:, 0], rel[:, 1], rel[:, 2]]
+
+        with navis.config.tqdm(total=len(chunks),
+                               desc='Looking up IDs',
+                               leave=False,
+                               disable=not progress or len(chunks) == 1) as pbar:
+            with ThreadPoolExecutor(max_workers=self.max_threads) as ex:
+                for ix, values in ex.map(_gather, chunks, groups):
+                    data[ix] = values
+                    pbar.update(1)
+
+        return data
+
+    def _get_chunk(self, chunk_ix):
+        """Return decoded chunk (x, y, z) and its start (relative to offset)."""
+        key = tuple(chunk_ix)
+        with self._lock:
+            if key in self._cache:
+                self._cache.move_to_end(key)
+                return self._cache[key]
+
+        start = np.asarray(chunk_ix) * self.chunk_size
+        stop = np.minimum(start + self.chunk_size, self.shape)
+        bbox = cloudvolume.Bbox(start + self.offset, stop + self.offset)
+        chunk = np.asarray(self.volume.download(bbox, mip=self.volume.mip))[..., 0]
+
+        with self._lock:
+            self._cache[key] = (chunk, start)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+        return chunk, start
+
+
+def group_by_chunk(vxl, chunk_size, grid=None):
+    """Group voxel coordinates by the chunk they are in.
+
+    Parameters
+    ----------
+    vxl :           (N, 3) array
+                    Voxel coordinates (relative to the volume's origin).
+    chunk_size :    (3, ) array
+                    Size of chunks in voxels.
+    grid :          (3, ) array, optional
+                    Number of chunks along each axis. If not provided will
+                    use the extent of ``vxl`` (which may then also contain
+                    negative coordinates).
+
+    Returns
+    -------
+    chunks :        (M, 3) array
+                    Index of each unique chunk along x, y and z.
+    groups :        list of arrays
+                    For each chunk the indices of the coordinates in ``vxl``.
+
+    """
+    chunk_ix = np.asarray(vxl, dtype=np.int64) // np.asarray(chunk_size)
+
+    # Without a grid, chunks are counted from the lowest chunk index
+    base = np.zeros(3, dtype=np.int64)
+    if grid is None:
+        base = chunk_ix.min(axis=0)
+        chunk_ix = chunk_ix - base
+        grid = chunk_ix.max(axis=0) + 1
+    grid = tuple(np.asarray(grid, dtype=np.int64))
+
+    # Integer key for each chunk
+    keys = np.ravel_multi_index(chunk_ix.T, grid)
+    keys, inverse = np.unique(keys, return_inverse=True)
+    inverse = inverse.ravel()
+
+    # Indices of coordinates sorted by chunk
+    order = np.argsort(inverse, kind='stable')
+    splits = np.cumsum(np.bincount(inverse, minlength=len(keys)))[:-1]
+
+    chunks = np.stack(np.unravel_index(keys, grid), axis=1) + base
+
+    return chunks, np.split(order, splits)
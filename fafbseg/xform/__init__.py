@@ -16,3 +16,5 @@
 """Module containing functions to transform data between brain spaces."""
 
 from .xform import *
+from .local import *
+from .cache import *
@@ -0,0 +1,229 @@
+#    A collection of tools to interface with manually traced and autosegmented
+#    data in FAFB.
+#
+#    Copyright (C) 2019 Philipp Schlegel
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+"""Cache for transform offsets."""
+
+import atexit
+
+import numpy as np
+
+from pathlib import Path
+
+__all__ = ['enable_cache', 'disable_cache']
+
+# Voxel coordinates are packed into a single 64 bit integer using 21 bits per
+# axis. The shift allows for (slightly) negative coordinates.
+_BITS = 21
+_SHIFT = 2 ** (_BITS - 1)
+
+# The currently active cache (None if caching is disabled)
+OFFSET_CACHE = None
+
+
+class OffsetCache:
+    """LRU cache mapping (dataset, mip, voxel) -> x/y offsets.
+
+    Lookups and inserts are vectorized: voxel coordinates are packed into
+    uint64 keys that are kept in sorted arrays and queried via
+    ``np.searchsorted``. When the cache grows beyond ``max_size`` entries
+    (per dataset and mip) the least recently used entries are dropped.
+
+    Parameters
+    ----------
+    max_size :      int
+                    Max number of voxels to keep per dataset and mip.
+    filepath :      str, optional
+                    If provided, the cache will be loaded from and can be saved
+                    to this file (``.npz``).
+
+    """
+
+    def __init__(self, max_size=1e7, filepath=None):
+        """Initialize."""
+        self.max_size = int(max_size)
+        self.filepath = Path(filepath).expanduser() if filepath else None
+
+        # {(dataset, mip): {'keys': ..., 'values': ..., 'used': ...}}
+        self.tables = {}
+        self.counter = 0
+
+        if self.filepath and self.filepath.is_file():
+            self.load()
+
+    def __len__(self):
+        return sum([len(t['keys']) for t in self.tables.values()])
+
+    def __repr__(self):
+        return f'<OffsetCache tables={len(self.tables)} entries={len(self)}>'
+
+    @staticmethod
+    def hash_voxels(vxl):
+        """Pack (N, 3) voxel coordinates into (N, ) uint64 keys.
+
+        Returns
+        -------
+        keys :      np.ndarray
+        valid :     np.ndarray
+                    Boolean array indicating which coordinates could be packed.
+                    Coordinates out of range get a key of 0.
+
+        """
+        vxl = np.round(np.asarray(vxl)).astype(np.int64) + _SHIFT
+        valid = np.all((vxl >= 0) & (vxl < 2 ** _BITS), axis=1)
+        vxl[~valid] = 0
+
+        vxl = vxl.astype(np.uint64)
+        keys = (vxl[:, 0] << np.uint64(2 * _BITS)) | (vxl[:, 1] << np.uint64(_BITS)) | vxl[:, 2]
+
+        return keys, valid
+
+    def lookup(self, dataset, mip, keys):
+        """Look up offsets for given keys.
+
+        Returns
+        -------
+        values :    np.ndarray
+                    (N, 2) array of offsets. NaN where not cached.
+        hit :       np.ndarray
+                    Boolean array indicating cache hits.
+
+        """
+        values = np.full((len(keys), 2), np.nan, dtype=np.float32)
+        hit = np.zeros(len(keys), dtype=bool)
+
+        table = self.tables.get((dataset, mip), None)
+        if table is None or not len(table['keys']):
+            return values, hit
+
+        ix = np.searchsorted(table['keys'], keys)
+        ix[ix >= len(table['keys'])] = 0
+        hit = table['keys'][ix] == keys
+
+        values[hit] = table['values'][ix[hit]]
+
+        # Keep track of usage for LRU
+        self.counter += 1
+        table['used'][ix[hit]] = self.counter
+
+        return values, hit
+
+    def insert(self, dataset, mip, keys, values):
+        """Add offsets to cache."""
+        # Never cache failed transforms
+        is_valid = ~np.any(np.isnan(values), axis=1)
+        keys, values = keys[is_valid], values[is_valid]
+
+        if not len(keys):
+            return
+
+        self.counter += 1
+        used = np.full(len(keys), self.counter)
+        table = self.tables.get((dataset, mip), None)
+        if table is not None:
+            # New entries go first -> np.unique will keep these on duplicates
+            keys = np.concatenate((keys, table['keys']))
+            values = np.concatenate((values, table['values']))
+            used = np.concatenate((used, table['used']))
+
+        keys, ix = np.unique(keys, return_index=True)
+        values, used = values[ix], used[ix]
+
+        # Drop least recently used entries
+        if len(keys) > self.max_size:
+            keep = np.sort(np.argsort(used, kind='stable')[-self.max_size:])
+            keys, values, used = keys[keep], values[keep], used[keep]
+
+        self.tables[(dataset, mip)] = {'keys': keys,
+                                       'values': values.astype(np.float32, copy=False),
+                                       'used': used}
+
+    def clear(self):
+        """Clear cache."""
+        self.tables = {}
+
+    def save(self, filepath=None):
+        """Save cache to disk."""
+        filepath = Path(filepath).expanduser() if filepath else self.filepath
+        if not filepath:
+            raise ValueError('Must provide filepath')
+
+        filepath.parent.mkdir(parents=True, exist_ok=True)
+        data = {}
+        for (ds, mip), table in self.tables.items():
+            data[f'{ds}::{mip}::keys'] = table['keys']
+            data[f'{ds}::{mip}::values'] = table['values']
+        with open(filepath, 'wb') as f:
+            np.savez(f, **data)
+
+    def load(self, filepath=None):
+        """Load cache from disk."""
+        filepath = Path(filepath).expanduser() if filepath else self.filepath
+        with np.load(filepath) as data:
+            for k in data.files:
+                ds, mip, what = k.split('::')
+                if what != 'keys':
+                    continue
+                keys = data[k]
+                self.tables[(ds, int(mip))] = {'keys': keys,
+                                               'values': data[f'{ds}::{mip}::values'],
+                                               'used': np.zeros(len(keys), dtype=int)}
+
+
+def enable_cache(max_size=1e7, persistent=False,
+                 filepath='~/.fafbseg/xform_cache.npz'):
+    """Enable caching of transform offsets.
+
+    With the cache enabled, transforms via
+    :func:`~fafbseg.xform.flywire_to_fafb14`, :func:`~fafbseg.xform.fafb14_to_flywire`
+    and the navis spine transforms only query offsets for voxels that have
+    not been transformed before.
+
+    Note that offsets are cached per voxel: coordinates are rounded to full
+    voxels before they are transformed.
+
+    Parameters
+    ----------
+    max_size :      int
+                    Max number of voxels to cache per transform and mip. Each
+                    entry takes 24 bytes.
+    persistent :    bool
+                    If True, will load the cache from ``filepath`` and save it
+                    back on exit.
+    filepath :      str
+                    File to persist the cache to.
+
+    Returns
+    -------
+    None
+
+    """
+    global OFFSET_CACHE
+
+    OFFSET_CACHE = OffsetCache(max_size=max_size,
+                               filepath=filepath if persistent else None)
+
+    if persistent:
+        atexit.register(_save_cache, OFFSET_CACHE)
+
+
+def disable_cache():
+    """Disable caching of transform offsets."""
+    global OFFSET_CACHE
+    OFFSET_CACHE = None
+
+
+def _save_cache(cache):
+    """Save cache (if it is still the active one)."""
+    if cache is OFFSET_CACHE and cache.filepath:
+        cache.save()
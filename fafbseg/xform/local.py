@@ -0,0 +1,365 @@
+#    A collection of tools to interface with manually traced and autosegmented
+#    data in FAFB.
+#
+#    Copyright (C) 2019 Philipp Schlegel
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+"""Local copies of the displacement fields behind the spine transforms."""
+
+import json
+import navis
+import os
+
+import numpy as np
+
+from pathlib import Path
+
+from .. import spine
+from . import cache
+
+__all__ = ['download_field', 'use_local_field']
+
+# Registry of local fields: {(dataset, mip): LocalField}
+LOCAL_FIELDS = {}
+
+
+class LocalField:
+    """Displacement field stored on local disk.
+
+    The field is a memory-mapped ``.npy`` file of shape ``(Z, Y, X, 2)``
+    containing x/y offsets (in voxels) on a regular grid. A JSON sidecar
+    (``{filepath}.json``) holds the meta data. Use :func:`download_field` to
+    generate one.
+
+    Parameters
+    ----------
+    filepath :      str
+                    Path to the ``.npy`` file.
+
+    """
+
+    def __init__(self, filepath):
+        """Initialize."""
+        self.filepath = Path(filepath).expanduser()
+
+        with open(f'{self.filepath}.json', 'r') as f:
+            self.meta = json.load(f)
+
+        self.dataset = self.meta['dataset']
+        self.mip = self.meta['mip']
+        self.scales = self.meta['scales']
+        self.voxel_size = np.array(self.meta['voxel_size'])
+        self.origin = np.array(self.meta['origin'])
+        self.spacing = np.array(self.meta['spacing'])
+
+        self.field = np.load(self.filepath, mmap_mode='r')
+
+    def __repr__(self):
+        return (f'<LocalField dataset="{self.dataset}" mip={self.mip} '
+                f'shape={self.field.shape}>')
+
+    def to_voxels(self, x, coordinates='nm'):
+        """Convert coordinates to voxels (float32)."""
+        x = np.asarray(x)
+
+        if x.ndim != 2 or x.shape[1] != 3:
+            raise TypeError(f'Expected (N, 3) array, got {x.shape}')
+
+        if coordinates in ('vxl', 'voxel', 'voxels'):
+            return x.astype(np.single, copy=False)
+
+        if not np.issubdtype(x.dtype, np.number):
+            x = x.astype(np.float64)
+
+        vxl = np.divide(x, self.voxel_size, dtype=np.single)
+        np.round(vxl, out=vxl)
+        return vxl
+
+    def get_offsets(self, x, coordinates='nm', on_fail='warn',
+                    chunksize=1e6):
+        """Get x/y offsets for given coordinates.
+
+        Uses trilinear interpolation between the grid points of the field.
+        Points outside the downloaded bounding box are not looked up via
+        the service: they get NaN offsets, i.e. they count as failed (see
+        ``on_fail``). Points next to grid points for which the service did
+        not return offsets are NaN as well.
+
+        Parameters
+        ----------
+        x :             np.ndarray (N, 3)
+                        Coordinates.
+        coordinates :   "nm" | "voxel"
+                        Units of the coordinates in ``x``.
+        on_fail :       "warn" | "ignore" | "raise"
+                        What to do if points failed to xform.
+        chunksize :     int
+                        Number of points to process at a time. This bounds
+                        the memory footprint.
+
+        Returns
+        -------
+        np.ndarray
+                        (N, 2) of dx and dy offsets in voxels.
+
+        """
+        vxl = self.to_voxels(x, coordinates=coordinates)
+
+        offsets = np.empty((vxl.shape[0], 2), dtype=self.field.dtype)
+        chunksize = int(chunksize)
+        for i in range(0, vxl.shape[0], chunksize):
+            offsets[i: i + chunksize] = self._interpolate(vxl[i: i + chunksize])
+
+        spine.transform.validate_output(offsets, on_fail=on_fail)
+
+        return offsets
+
+    def _interpolate(self, vxl):
+        """Trilinear interpolation of the field at given voxels."""
+        # Fractional position within the grid in (x, y, z) order
+        grid = (vxl - self.origin) / self.spacing
+        shape = np.array(self.field.shape[:3][::-1])
+
+        # Points outside the field can't be transformed
+        oob = np.any(grid < 0, axis=1) | np.any(grid > shape - 1, axis=1)
+
+        grid = np.clip(grid, 0, shape - 1)
+        lo = np.floor(grid).astype(int)
+        lo = np.minimum(lo, np.maximum(shape - 2, 0))
+        frac = grid - lo
+        hi = np.minimum(lo + 1, shape - 1)
+
+        res = np.zeros((vxl.shape[0], 2), dtype=np.float64)
+        for cx in (0, 1):
+            ix = hi[:, 0] if cx else lo[:, 0]
+            wx = frac[:, 0] if cx else 1 - frac[:, 0]
+            for cy in (0, 1):
+                iy = hi[:, 1] if cy else lo[:, 1]
+                wy = frac[:, 1] if cy else 1 - frac[:, 1]
+                for cz in (0, 1):
+                    iz = hi[:, 2] if cz else lo[:, 2]
+                    wz = frac[:, 2] if cz else 1 - frac[:, 2]
+                    # Field is stored as (Z, Y, X, 2)
+                    res += self.field[iz, iy, ix] * (wx * wy * wz)[:, None]
+
+        res[oob] = np.nan
+
+        return res
+
+
+def download_field(dataset, filepath, bbox, mip=4, z_step=1, slab=1,
+                   progress=True):
+    """Download a displacement field from spine to local disk.
+
+    This works by sampling the transform service on the grid of the given
+    mip and writing the offsets into a memory-mapped ``.npy`` file. Once
+    downloaded, use :func:`use_local_field` to have
+    :func:`~fafbseg.xform.flywire_to_fafb14`, :func:`~fafbseg.xform.fafb14_to_flywire`
+    and the navis transforms use the local copy instead of the web service.
+
+    Parameters
+    ----------
+    dataset :       "flywire_v1" | "flywire_v1_inverse"
+                    Which transform to download.
+    filepath :      str
+                    Where to save the field (``.npy``). The meta data is
+                    written to ``{filepath}.json``.
+    bbox :          array-like
+                    Bounding box in (mip 0) voxels to download::
+
+                        [[xmin, xmax], [ymin, ymax], [zmin, zmax]]
+
+    mip :           int
+                    Resolution of the field. Grid spacing is ``2 ** mip``
+                    voxels in x/y.
+    z_step :        int
+                    Grid spacing in z (in sections). Offsets between grid
+                    points are interpolated.
+    slab :          int
+                    Number of z grid planes to query per batch.
+    progress :      bool
+                    Whether to show a progress bar.
+
+    Returns
+    -------
+    LocalField
+
+    Notes
+    -----
+    The field has ``nx * ny * nz`` grid points, with
+    ``nx = (xmax - xmin) / 2 ** mip``, ``ny = (ymax - ymin) / 2 ** mip`` and
+    ``nz = (zmax - zmin) / z_step``. Each grid point is one query against the
+    service and takes 8 bytes on disk (2 x float32). For example, the full
+    brain (``[[0, 270000], [0, 135000], [0, 7063]]``) at ``mip=6`` and
+    ``z_step=1`` is about 63e9 points or 500 GB. At ``z_step=64``, that goes
+    down to about 1e9 points or 8 GB, which is still a lot of requests.
+    Download only the region you need.
+
+    Examples
+    --------
+    >>> from fafbseg import xform
+    >>> # About 13e6 grid points (~100 MB)
+    >>> field = xform.download_field('flywire_v1', '~/flywire_v1_mip6.npy',
+    ...                              bbox=[[100000, 150000],
+    ...                                    [40000, 80000],
+    ...                                    [2000, 3000]],
+    ...                              mip=6, z_step=40)
+    >>> xform.use_local_field(field)
+
+    """
+    spine.transform.validate_dataset(dataset)
+    scales = sorted(spine.transform.info[dataset]['scales'])
+    mip = spine.transform.validate_mip(mip, dataset=dataset)
+
+    bbox = np.asarray(bbox).astype(int)
+    if bbox.shape != (3, 2):
+        raise ValueError(f'Expected bbox of shape (3, 2), got {bbox.shape}')
+
+    z_step = max(int(z_step), 1)
+    spacing = np.array([2 ** mip, 2 ** mip, z_step])
+    origin = bbox[:, 0] - bbox[:, 0] % spacing
+
+    # Grid coordinates along each axis
+    xs = np.arange(origin[0], bbox[0, 1] + spacing[0], spacing[0])
+    ys = np.arange(origin[1], bbox[1, 1] + spacing[1], spacing[1])
+    zs = np.arange(origin[2], bbox[2, 1] + spacing[2], spacing[2])
+
+    n_points = len(xs) * len(ys) * len(zs)
+    n_bytes = n_points * 2 * np.dtype(spine.transform.DTYPES[dataset]).itemsize
+    if n_bytes > 1e9:
+        print(f'Downloading {n_points:,} grid points ({n_bytes / 1e9:.1f} GB). '
+              'Consider a smaller bbox, a higher mip or a larger z_step.')
+
+    filepath = Path(filepath).expanduser()
+    field = np.lib.format.open_memmap(filepath, mode='w+',
+                                      dtype=spine.transform.DTYPES[dataset],
+                                      shape=(len(zs), len(ys), len(xs), 2))
+
+    # Grid for a single section in (Y, X) order
+    gy, gx = np.meshgrid(ys, xs, indexing='ij')
+    gy, gx = gy.ravel(), gx.ravel()
+
+    slab = max(int(slab), 1)
+    for i in navis.config.tqdm(range(0, len(zs), slab),
+                               desc='Downloading',
+                               disable=not progress,
+                               leave=False):
+        this_zs = zs[i: i + slab]
+        vxl = np.empty((len(this_zs) * len(gx), 3), dtype=np.single)
+        vxl[:, 0] = np.tile(gx, len(this_zs))
+        vxl[:, 1] = np.tile(gy, len(this_zs))
+        vxl[:, 2] = np.repeat(this_zs, len(gx))
+
+        offsets = spine.transform.get_offsets(vxl, transform=dataset,
+                                              coordinates='voxel', mip=mip,
+                                              on_fail='ignore',
+                                              progress=False)
+        field[i: i + len(this_zs)] = offsets.reshape(len(this_zs), len(ys), len(xs), 2)
+
+    field.flush()
+    del field
+
+    meta = {'dataset': dataset,
+            'mip': int(mip),
+            'scales': [int(s) for s in scales],
+            'voxel_size': list(spine.transform.info[dataset]['voxel_size']),
+            'origin': origin.tolist(),
+            'spacing': spacing.tolist()}
+    with open(f'{filepath}.json', 'w') as f:
+        json.dump(meta, f)
+
+    return LocalField(filepath)
+
+
+def use_local_field(field):
+    """Use a local displacement field instead of the spine web service.
+
+    After registering, all transforms for the field's dataset and mip
+    (including negative mips that resolve to it) are computed locally.
+
+    Parameters
+    ----------
+    field :     str | LocalField
+                Either a path to a field generated by
+                :func:`download_field` or a ``LocalField``.
+
+    Returns
+    -------
+    None
+
+    """
+    if not isinstance(field, LocalField):
+        if not os.path.isfile(os.path.expanduser(f'{field}.json')):
+            raise ValueError(f'No meta data for field "{field}" found.')
+        field = LocalField(field)
+
+    LOCAL_FIELDS[(field.dataset, field.mip)] = field
+
+
+def get_local_field(dataset, mip):
+    """Return registered local field for given dataset and mip (or None)."""
+    if mip < 0:
+        # Resolve negative mips using the scales recorded with the field
+        for (ds, m), field in LOCAL_FIELDS.items():
+            if ds == dataset and len(field.scales) >= -mip:
+                if field.scales[-mip - 1] == m:
+                    return field
+        return None
+
+    return LOCAL_FIELDS.get((dataset, mip), None)
+
+
+def get_offsets(x, dataset, coordinates='nm', mip=-1, on_fail='warn'):
+    """Get offsets - locally if possible, else via the spine service.
+
+    If caching is enabled (see :func:`~fafbseg.xform.enable_cache`) only
+    voxels that are not already cached will be transformed.
+
+    """
+    field = get_local_field(dataset, mip)
+
+    if cache.OFFSET_CACHE is None:
+        return _fetch_offsets(x, dataset, field=field, coordinates=coordinates,
+                              mip=mip, on_fail=on_fail)
+
+    # Offsets are cached per voxel
+    if field is not None:
+        vxl = field.to_voxels(x, coordinates=coordinates)
+    else:
+        vxl = spine.transform.to_voxels(x, dataset, coordinates=coordinates)
+    vxl = np.round(vxl)
+
+    keys, cacheable = cache.OFFSET_CACHE.hash_voxels(vxl)
+    offsets, hit = cache.OFFSET_CACHE.lookup(dataset, mip, keys)
+
+    miss = ~(hit & cacheable)
+    if np.any(miss):
+        offsets[miss] = _fetch_offsets(vxl[miss], dataset, field=field,
+                                       coordinates='voxel', mip=mip,
+                                       on_fail='ignore')
+        to_cache = miss & cacheable
+        cache.OFFSET_CACHE.insert(dataset, mip, keys[to_cache], offsets[to_cache])
+
+    spine.transform.validate_output(offsets, on_fail=on_fail)
+
+    return offsets
+
+
+def _fetch_offsets(x, dataset, field=None, coordinates='nm', mip=-1,
+                   on_fail='warn'):
+    """Get offsets from local field (if provided) or the spine service."""
+    if field is not None:
+        return field.get_offsets(x, coordinates=coordinates, on_fail=on_fail)
+
+    return spine.transform.get_offsets(x, transform=dataset,
+                                       coordinates=coordinates,
+                                       mip=mip,
+                                       on_fail=on_fail)
@@ -21,7 +21,8 @@ import trimesh as tm
 from navis.transforms.base import BaseTransform, AliasTransform
 from navis.transforms.affine import AffineTransform
 
-from .. import utils, spine
+from .. import utils
+from . import local
 use_pbars = utils.use_pbars
 
 __all__ = ['fafb14_to_flywire', 'flywire_to_fafb14', 'register_transforms']
@@ -115,11 +116,12 @@ class SpineTransform(BaseTransform):
             dataset = self.inv_dataset
 
         # This returns offsets along x and y axis
-        offsets = spine.transform.get_offsets(points,
-                                              transform=dataset,
-                                              coordinates=self.coordinates,
-                                              mip=self.mip,
-                                              on_fail=self.on_fail)
+        # (uses a local copy of the field if one has been registered)
+        offsets = local.get_offsets(points,
+                                    dataset=dataset,
+                                    coordinates=self.coordinates,
+                                    mip=self.mip,
+                                    on_fail=self.on_fail)
 
         # We need to cast x to the same type as offsets -> likely float 64
         # This also makes a copy - do not change that!
@@ -173,7 +175,9 @@ def register_transforms():
 def fafb14_to_flywire(x, coordinates='nm', mip=4, inplace=False, on_fail='warn'):
     """Transform neurons/coordinates from FAFB v14 to flywire.
 
-    This uses a service hosted by Eric Perlman.
+    This uses a service hosted by Eric Perlman. Use
+    :func:`~fafbseg.xform.use_local_field` to use a local copy of the
+    transform instead.
 
     Parameters
     ----------
@@ -208,7 +212,9 @@ def fafb14_to_flywire(x, coordinates='nm', mip=4, inplace=False, on_fail='warn')
 def flywire_to_fafb14(x, coordinates=None, mip=2, inplace=False, on_fail='warn'):
     """Transform neurons/coordinates from flywire to FAFB V14.
 
-    This uses a service hosted by Eric Perlman.
+    This uses a service hosted by Eric Perlman. Use
+    :func:`~fafbseg.xform.use_local_field` to use a local copy of the
+    transform instead.
 
     Parameters
     ----------
@@ -284,45 +290,31 @@ def _flycon(x, dataset, base_url='https://spine.janelia.org/app/transform-servic
                     Returns same data type as input.
 
     """
-    if isinstance(x, navis.NeuronList):
-        return x.__class__([_flycon(n,
-                                    dataset=dataset,
-                                    on_fail=on_fail,
-                                    coordinates=coordinates,
-                                    mip=mip,
-                                    base_url=base_url,
-                                    inplace=inplace) for n in x])
-    elif isinstance(x, (navis.BaseNeuron, navis.Volume, tm.Trimesh)):
+    if isinstance(x, (navis.NeuronList, navis.BaseNeuron, navis.Volume, tm.Trimesh)):
         if not inplace:
             x = x.copy()
 
-        if isinstance(x, navis.TreeNeuron):
-            x.nodes[['x', 'y', 'z']] = _flycon(x.nodes[['x', 'y', 'z']].values,
-                                               dataset=dataset,
-                                               on_fail=on_fail,
-                                               coordinates=coordinates,
-                                               mip=mip,
-                                               base_url=base_url,
-                                               inplace=inplace)
-        elif isinstance(x, (navis.MeshNeuron, navis.Volume, tm.Trimesh)):
-            x.vertices = _flycon(x.vertices,
-                                 dataset=dataset,
-                                 on_fail=on_fail,
-                                 coordinates=coordinates,
-                                 mip=mip,
-                                 base_url=base_url,
-                                 inplace=inplace)
-        else:
-            raise TypeError(f'Unable to convert neuron of type "{type(x)}"')
+        # Gather the coordinates (nodes, vertices, connectors) of all objects
+        # so that we can transform them in one go
+        objects = x if isinstance(x, navis.NeuronList) else [x]
+        coords = [_get_coords(o) for o in objects]
+        flat = [c for cc in coords for c in cc]
+
+        if not flat:
+            return x
+
+        xf = _flycon(np.concatenate(flat, axis=0),
+                     dataset=dataset,
+                     on_fail=on_fail,
+                     coordinates=coordinates,
+                     mip=mip,
+                     base_url=base_url,
+                     inplace=inplace)
 
-        if isinstance(x, navis.BaseNeuron) and x.has_connectors:
-            x.connectors[['x', 'y', 'z']] = _flycon(x.connectors[['x', 'y', 'z']].values,
-                                                    dataset=dataset,
-                                                    on_fail=on_fail,
-                                                    coordinates=coordinates,
-                                                    mip=mip,
-                                                    base_url=base_url,
-                                                    inplace=inplace)
+        # Split back by offsets and assign
+        xf = iter(np.split(xf, np.cumsum([len(c) for c in flat])[:-1]))
+        for o, cc in zip(objects, coords):
+            _set_coords(o, [next(xf) for _ in cc])
 
         return x
 
@@ -333,10 +325,11 @@ def _flycon(x, dataset, base_url='https://spine.janelia.org/app/transform-servic
         raise ValueError(f'Expected coordinates of shape (N, 3), got {x.shape}')
 
     # This returns offsets along x and y axis
-    offsets = spine.transform.get_offsets(x, transform=dataset,
-                                          coordinates=coordinates,
-                                          mip=mip,
-                                          on_fail=on_fail)
+    # (uses a local copy of the field if one has been registered)
+    offsets = local.get_offsets(x, dataset=dataset,
+                                coordinates=coordinates,
+                                mip=mip,
+                                on_fail=on_fail)
 
     # `offsets` will always be in voxels - if our data is in nanometers, we have
     #  to convert them
@@ -350,3 +343,29 @@ def _flycon(x, dataset, base_url='https://spine.janelia.org/app/transform-servic
     x[:, :2] += offsets
 
     return x
+
+
+def _get_coords(x):
+    """Collect arrays of coordinates (nodes/vertices, connectors) for object."""
+    if isinstance(x, navis.TreeNeuron):
+        coords = [x.nodes[['x', 'y', 'z']].values]
+    elif isinstance(x, (navis.MeshNeuron, navis.Volume, tm.Trimesh)):
+        coords = [np.asarray(x.vertices)]
+    else:
+        raise TypeError(f'Unable to convert neuron of type "{type(x)}"')
+
+    if isinstance(x, navis.BaseNeuron) and x.has_connectors:
+        coords.append(x.connectors[['x', 'y', 'z']].values)
+
+    return coords
+
+
+def _set_coords(x, coords):
+    """Set coordinates as returned by `_get_coords` for object."""
+    if isinstance(x, navis.TreeNeuron):
+        x.nodes[['x', 'y', 'z']] = coords[0]
+    else:
+        x.vertices = coords[0]
+
+    if isinstance(x, navis.BaseNeuron) and x.has_connectors:
+        x.connectors[['x', 'y', 'z']] = coords[1]
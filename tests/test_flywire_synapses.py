@@ -0,0 +1,110 @@
+#    A collection of tools to interface with manually traced and autosegmented
+#    data in FAFB.
+#
+#    Copyright (C) 2019 Philipp Schlegel
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+
+import numpy as np
+import pyarrow as pa
+import pytest
+
+from pyarrow import feather
+
+from fafbseg import spine
+from fafbseg.flywire import synapses
+from fafbseg.synapses import SynapseTable
+
+# Realistically sized IDs: float64 can't tell neighbouring ones apart
+QUERY_ROOT = 720575940000000001
+QUERY_SVXL = 78000000000000001
+PARTNERS = {78000000000000002: 720575940000000002,
+            78000000000000003: 720575940000000003}
+
+
+def _fake_supervoxels_to_roots(x, dataset='production'):
+    return np.array([PARTNERS[int(i)] for i in x], dtype=np.int64)
+
+
+def test_supervoxels_to_roots_keeps_precision(monkeypatch):
+    monkeypatch.setattr(synapses, 'get_materialization', lambda dataset: None)
+    monkeypatch.setattr(synapses, 'supervoxels_to_roots',
+                        _fake_supervoxels_to_roots)
+
+    # Backends return uint64
+    pre = np.array([QUERY_SVXL, QUERY_SVXL], dtype=np.uint64)
+    post = np.array(list(PARTNERS), dtype=np.uint64)
+    roots2svxl = {QUERY_ROOT: np.array([QUERY_SVXL], dtype=np.int64)}
+
+    roots_pre, roots_post = synapses._supervoxels_to_roots(pre, post,
+                                                           roots2svxl=roots2svxl)
+
+    assert roots_pre.dtype == np.int64
+    assert roots_post.dtype == np.int64
+    assert roots_pre.tolist() == [QUERY_ROOT, QUERY_ROOT]
+    assert roots_post.tolist() == list(PARTNERS.values())
+
+
+# Three neurons with (partially) multiple supervoxels
+ROOTS2SVXL = {720575940000000001: np.array([78000000000000001, 78000000000000002]),
+              720575940000000002: np.array([78000000000000003]),
+              720575940000000003: np.array([78000000000000004])}
+
+
+@pytest.fixture
+def synapse_table(tmp_path):
+    pre = [78000000000000001, 78000000000000002, 78000000000000003,
+           78000000000000004, 78000000000000001, 78000000000000004]
+    post = [78000000000000003, 78000000000000004, 78000000000000001,
+            78000000000000002, 78000000000000002, 78000000000000005]
+    fp = tmp_path / 'synapses.feather'
+    feather.write_feather(pa.table({'pre': np.array(pre, dtype=np.uint64),
+                                    'post': np.array(post, dtype=np.uint64),
+                                    'cleft_scores': np.full(len(pre), 100, dtype=np.uint8)}),
+                          str(fp), compression='uncompressed')
+    return SynapseTable(fp)
+
+
+@pytest.fixture(params=['local', 'spine'])
+def backend(request, monkeypatch, synapse_table):
+    monkeypatch.setattr(synapses, 'is_latest_root',
+                        lambda x, dataset='production': np.ones(len(x), dtype=bool))
+    monkeypatch.setattr(synapses, 'roots_to_supervoxels',
+                        lambda x, dataset='production', progress=True: ROOTS2SVXL)
+
+    if request.param == 'local':
+        monkeypatch.setattr(synapses, 'SYNAPSE_BACKEND', synapse_table)
+    else:
+        # Serve the web service's per-chunk responses from the local table
+        def _iter_feather(url, chunks, max_threads=4, progress=False):
+            for c in chunks:
+                yield synapse_table.get_connectivity(c, as_arrow=True)
+
+        monkeypatch.setattr(synapses, 'SYNAPSE_BACKEND', None)
+        monkeypatch.setattr(spine.synapses, 'validate_segmentation', lambda x: None)
+        monkeypatch.setattr(spine.synapses, '_iter_feather', _iter_feather)
+
+    return request.param
+
+
+@pytest.mark.parametrize('block_size', [1, 2, 3])
+def test_adjacency_blocks_match_single_query(backend, block_size):
+    ids = list(ROOTS2SVXL)
+
+    adj, _, _ = synapses.fetch_adjacency(ids, sparse=True, block_size=None,
+                                         progress=False)
+    adj_blocks, _, _ = synapses.fetch_adjacency(ids, sparse=True,
+                                                block_size=block_size,
+                                                progress=False)
+
+    # 5 synapses between the query neurons (the 6th goes to a non-query)
+    assert adj.sum() == 5
+    assert (adj != adj_blocks).nnz == 0
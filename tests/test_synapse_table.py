@@ -0,0 +1,43 @@
+#    A collection of tools to interface with manually traced and autosegmented
+#    data in FAFB.
+#
+#    Copyright (C) 2019 Philipp Schlegel
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+
+import numpy as np
+import pyarrow as pa
+import pytest
+
+from pyarrow import feather
+
+from fafbseg.synapses import SynapseTable
+
+
+@pytest.fixture
+def table(tmp_path):
+    fp = tmp_path / 'synapses.feather'
+    feather.write_feather(pa.table({'pre': np.array([1, 2, 3], dtype=np.uint64),
+                                    'post': np.array([2, 1, 4], dtype=np.uint64),
+                                    'cleft_scores': np.array([50, 60, 70], dtype=np.uint8)}),
+                          str(fp), compression='uncompressed')
+    return SynapseTable(fp)
+
+
+@pytest.mark.parametrize('chunksize', [1, 2, 10])
+def test_iterator_matches_single_query(table, chunksize):
+    ids = [1, 2]
+    full = table.get_connectivity(ids, as_arrow=True)
+    chunks = list(table.get_connectivity(ids, iterator=True, as_arrow=True,
+                                         chunksize=chunksize))
+
+    assert full.num_rows == 2
+    assert sum(t.num_rows for t in chunks) == full.num_rows
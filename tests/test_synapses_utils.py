@@ -0,0 +1,51 @@
+#    A collection of tools to interface with manually traced and autosegmented
+#    data in FAFB.
+#
+#    Copyright (C) 2019 Philipp Schlegel
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+
+import numpy as np
+import pandas as pd
+
+from fafbseg.synapses.utils import drop_duplicate_synapses
+
+
+def _synapses(pre, post, scores):
+    n = len(pre)
+    # All synapses at (almost) the same location
+    locs = np.arange(n)[:, None] * np.ones((1, 3))
+    return pd.DataFrame({'segmentid_pre': pre,
+                         'segmentid_post': post,
+                         'cleft_scores': scores,
+                         'pre_x': locs[:, 0], 'pre_y': locs[:, 1], 'pre_z': locs[:, 2],
+                         'post_x': locs[:, 0], 'post_y': locs[:, 1], 'post_z': locs[:, 2]})
+
+
+def test_drop_duplicates():
+    syn = _synapses([1, 1, 2], [2, 2, 1], [10, 50, 10])
+    assert drop_duplicate_synapses(syn).tolist() == [False, True, True]
+
+
+def test_drop_duplicates_unmapped_ids():
+    # Unmapped IDs (NaN, e.g. from a failed segment look-up) and background
+    # (0) are carried through unchanged
+    syn = _synapses([1, 1, np.nan, np.nan, 0, 0],
+                    [2, 2, 2, 2, 2, 2],
+                    [10, 50, 10, 50, 10, 50])
+    assert drop_duplicate_synapses(syn).tolist() == [False, True,
+                                                     True, True,
+                                                     True, True]
+
+
+def test_drop_duplicates_all_unmapped():
+    syn = _synapses([np.nan, np.nan], [np.nan, 2], [10, 50])
+    assert drop_duplicate_synapses(syn).tolist() == [True, True]
@@ -0,0 +1,36 @@
+#    A collection of tools to interface with manually traced and autosegmented
+#    data in FAFB.
+#
+#    Copyright (C) 2019 Philipp Schlegel
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+
+import numpy as np
+import pandas as pd
+
+from fafbseg.synapses.transmitters import collapse_nt_predictions, trans
+
+
+def test_collapse_keeps_input_order():
+    pred = pd.DataFrame(np.zeros((6, len(trans))), columns=trans)
+    pred['pre'] = [11, 3, 7, 99, 3, 11]
+    pred['cleft_scores'] = [50, 50, 50, 50, 50, 50]
+    pred['acetylcholine'] = [0.9, 0, 0.8, 0.7, 0.9, 0.9]
+    pred['gaba'] = [0.1, 0, 0.2, 0.3, 0.1, 0.1]
+    # 99 has no cleft scores
+    pred.loc[3, 'cleft_scores'] = 0
+
+    res = collapse_nt_predictions(pred, single_pred=True, id_col='pre')
+
+    assert list(res) == [11, 3, 7, 99]
+    assert res[11] == ('acetylcholine', 0.9)
+    assert res[99] == ('gaba', 0)
+    assert isinstance(res[99][1], np.int64)